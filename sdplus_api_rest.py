@@ -1,14 +1,1000 @@
+import bisect
+import collections
+import collections.abc
+import concurrent.futures
+import contextlib
+import copy
 import datetime
-import json
-import requests
-import xmltodict
-import xml.etree.ElementTree as ET
+import functools
+import importlib
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+import xml.parsers.expat
 import urllib.parse
-__version__ = '1.1'
+
+
+class _LazyModule:
+    """
+    Stands in for a module, importing it on first attribute access - so importing sdplus_api_rest stays quick for
+    one call scripts e.g. aiohttp is only loaded by AsyncAPI, xmltodict only by bypass=True calls.
+    On first use it replaces itself with the module in this module's globals, so later lookups cost nothing extra.
+    """
+    def __init__(self, name, global_name):
+        self._name = name
+        self._global_name = global_name
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self._name)
+        globals()[self._global_name] = module
+        return getattr(module, attribute)
+
+
+aiohttp = _LazyModule('aiohttp', 'aiohttp')  # only needed for AsyncAPI
+asyncio = _LazyModule('asyncio', 'asyncio')
+ET = _LazyModule('xml.etree.ElementTree', 'ET')
+hashlib = _LazyModule('hashlib', 'hashlib')
+json = _LazyModule('json', 'json')
+pickle = _LazyModule('pickle', 'pickle')
+requests = _LazyModule('requests', 'requests')
+sqlite3 = _LazyModule('sqlite3', 'sqlite3')
+uuid = _LazyModule('uuid', 'uuid')
+xmltodict = _LazyModule('xmltodict', 'xmltodict')
+__version__ = '1.21'
 # 0.2 moves create_xml to internal method
 # 0.3 implements xmltodict and json for more complex returned xml
 # 1.0 Add class methods, matching the API
 # 1.1 updated technician_get_all
+# 1.2 pooled keep-alive session with timeouts, close() and context manager
+# 1.3 bulk() runs many calls through a bounded thread pool
+# 1.4 AsyncAPI: asyncio version of API using aiohttp
+# 1.5 iter_requests() pages through GET_REQUESTS lazily
+# 1.6 send_records() parses record lists incrementally instead of via xmltodict
+# 1.7 technician and request filter lookups cached (TTLCache / DiskCache)
+# 1.8 client side rate limits (RateLimiter) and adaptive concurrency (AdaptiveConcurrency)
+# 1.9 retries with backoff for transient errors (RetryPolicy)
+# 1.10 RequestMirror: incremental sync of requests, conversations and notes to sqlite
+# 1.11 RequestStore: in-memory indexed queries over fetched requests
+# 1.12 compact RequestRecord/ConversationRecord rows with lazy datetime conversion
+# 1.13 per call timings, sizes and status (Metrics), exportable in prometheus format
+# 1.14 attachments streamed from paths, file objects or byte iterators; request_add_attachments()
+# 1.15 request xml built from cached per field set templates
+# 1.16 RequestWatcher: polls a queue from high-water marks, emitting created/updated/conversation events
+# 1.17 RequestExporter: full queue export to sharded JSON Lines/Parquet files over a process pool, resumable
+# 1.18 WriteQueue: write-behind note_add/request_edit/request_assign, merged, ordered per request, kept on disk
+# 1.19 identical concurrent GET_ calls share one http request (single flight)
+# 1.20 requests, xmltodict, aiohttp etc. imported on first use; python -m sdplus_api_rest command line
+# 1.21 request_view_changed()/request_get_new_conversations() skip responses unchanged since last fetched
+
+BulkResult = collections.namedtuple('BulkResult', ['args', 'result', 'error'])
+WatchEvent = collections.namedtuple('WatchEvent', ['type', 'request_id', 'request', 'conversation'])
+
+
+@contextlib.contextmanager
+def _sqlite_connect(path):
+    db = sqlite3.connect(path, timeout=30)
+    try:
+        with db:  # commits, or rolls back on error
+            yield db
+    finally:
+        db.close()
+
+
+def _epoch_ms(value):
+    return int(round(value.timestamp() * 1000)) if isinstance(value, datetime.datetime) else int(value)
+
+
+def _json(value):
+    return json.dumps(value, sort_keys=True,
+                      default=lambda item: dict(item) if isinstance(item, collections.abc.Mapping) else str(item))
+
+
+def _notes_details(api, request_id):
+    # GET_NOTES Details, bypassing the cache and returning None when the request has no notes
+    notes = api.send('request/' + str(request_id) + '/notes/', 'GET_NOTES', bypass=True)
+    try:
+        return notes['API']['response']['operation']['Details']
+    except (KeyError, TypeError):
+        return None
+
+
+class TTLCache:
+    """
+    In-process cache for reference data (e.g. technicians), with a time to live and a least recently used size limit.
+    Thread safe - one instance can be shared by several API instances.
+    """
+    def __init__(self, ttl=300, maxsize=128):
+        """
+        :param ttl: seconds an entry is kept for (0 to not cache)
+        :param maxsize: max entries kept - the least recently used are dropped first
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()  # key: (expires, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """
+        :param key: key to remove, or None to clear the whole cache
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+class DiskCache:
+    """
+    As TTLCache, but kept in an sqlite file so it is shared between processes and survives restarts.
+    Values must be picklable.
+    """
+    def __init__(self, path, ttl=300, maxsize=1024):
+        """
+        :param path: sqlite file path e.g. 'sdplus_cache.db'
+        :param ttl: seconds an entry is kept for (0 to not cache)
+        :param maxsize: max entries kept - the least recently used are dropped first
+        """
+        self.path = path
+        self.ttl = ttl
+        self.maxsize = maxsize
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS cache '
+                       '(key TEXT PRIMARY KEY, value BLOB, expires REAL, used REAL)')
+
+    def _connect(self):
+        return _sqlite_connect(self.path)
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._connect() as db:
+            row = db.execute('SELECT value, expires FROM cache WHERE key = ?', (repr(key),)).fetchone()
+            if row is None:
+                return default
+            if row[1] < now:
+                db.execute('DELETE FROM cache WHERE key = ?', (repr(key),))
+                return default
+            db.execute('UPDATE cache SET used = ? WHERE key = ?', (now, repr(key)))
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        now = time.time()
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                       (repr(key), pickle.dumps(value), now + self.ttl, now))
+            db.execute('DELETE FROM cache WHERE key NOT IN (SELECT key FROM cache ORDER BY used DESC LIMIT ?)',
+                       (self.maxsize,))
+
+    def invalidate(self, key=None):
+        """
+        :param key: key to remove, or None to clear the whole cache
+        """
+        with self._connect() as db:
+            if key is None:
+                db.execute('DELETE FROM cache')
+            else:
+                db.execute('DELETE FROM cache WHERE key = ?', (repr(key),))
+
+
+class VersionStore:
+    """
+    Content hashes of responses already seen, keyed by (operation, request id), so unchanged responses are skipped
+    before being parsed - see API.request_view_changed and API.request_get_new_conversations. Thread safe.
+    """
+    def __init__(self):
+        self._versions = {}  # (operation, request id): version
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._versions)
+
+    @staticmethod
+    def digest(content):
+        """
+        :param content: response body bytes
+        :return: 16 byte hash
+        """
+        return hashlib.blake2b(content, digest_size=16).digest()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._versions.get(key, default)
+
+    def set(self, key, version):
+        with self._lock:
+            self._versions[key] = version
+
+    def compare_and_set(self, key, expected, version):
+        """
+        Sets key to version only if it is still expected, so a concurrent update isn't lost or repeated
+        :param expected: version read before (None if there wasn't one)
+        :return: True if set
+        """
+        with self._lock:
+            if self._versions.get(key) != expected:
+                return False
+            self._versions[key] = version
+            return True
+
+    def forget(self, request_id=None):
+        """
+        :param request_id: request to forget, so it is returned in full next time (None for all requests)
+        """
+        with self._lock:
+            if request_id is None:
+                self._versions.clear()
+            else:
+                for key in [key for key in self._versions if key[1] == str(request_id)]:
+                    del self._versions[key]
+
+
+class RateLimiter:
+    """
+    Token bucket - allows rate calls per second on average, with bursts of up to burst calls.
+    Thread safe - one instance can be shared by several API instances.
+    """
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: calls per second
+        :param burst: calls that can be made at once after a quiet period
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token, borrowing against the future if none are left
+        :return: seconds to wait before making the call
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        """
+        Blocks until a call can be made
+        """
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    """
+    Limits calls open at once, adjusting the limit to what the server can take: the limit goes up by one after
+    limit healthy calls in a row, and is halved when a call errors or is slower than latency_target. Calls already
+    open when the limit was halved don't halve it again, so a burst of failures cuts it once.
+    Thread safe - one instance can be shared by several API instances, sync or async.
+    """
+    def __init__(self, initial=4, minimum=1, maximum=32, latency_target=2.0):
+        """
+        :param initial: starting limit
+        :param minimum: the limit never drops below this
+        :param maximum: the limit never goes above this
+        :param latency_target: seconds - slower calls count as unhealthy
+        """
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self._open = 0
+        self._healthy = 0
+        self._decreased = None  # time.monotonic() of the last cut
+        self._condition = threading.Condition()
+        self._async_waiters = []  # (event loop, future) for each acquire_async() waiting
+
+    def try_acquire(self):
+        """
+        :return: True if the call can be made now (and it must then be released), False if at the limit
+        """
+        with self._condition:
+            if self._open < self.limit:
+                self._open += 1
+                return True
+            return False
+
+    def acquire(self):
+        """
+        Blocks until a call can be made
+        """
+        with self._condition:
+            while self._open >= self.limit:
+                self._condition.wait()
+            self._open += 1
+
+    async def acquire_async(self):
+        """
+        As acquire(), without blocking the event loop - waits to be woken by release()
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self._open < self.limit:
+                    self._open += 1
+                    return
+                waiter = (loop, loop.create_future())
+                self._async_waiters.append(waiter)
+            try:
+                await waiter[1]
+            finally:
+                with self._condition:
+                    if waiter in self._async_waiters:
+                        self._async_waiters.remove(waiter)
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
+
+    def release(self, latency, failed=False):
+        """
+        Report a finished call
+        :param latency: seconds the call took
+        :param failed: True if the call errored
+        """
+        with self._condition:
+            self._open -= 1
+            if failed or latency > self.latency_target:
+                self._healthy = 0
+                now = time.monotonic()
+                if self._decreased is None or now - latency >= self._decreased:  # started after the last cut
+                    self._decreased = now
+                    self.limit = max(self.minimum, self.limit // 2)
+            else:
+                self._healthy += 1
+                if self._healthy >= self.limit:
+                    self._healthy = 0
+                    self.limit = min(self.maximum, self.limit + 1)
+            self._condition.notify_all()
+            for loop, future in self._async_waiters:
+                with contextlib.suppress(RuntimeError):  # loop closed
+                    loop.call_soon_threadsafe(self._wake, future)
+            self._async_waiters.clear()
+
+
+class RetryPolicy:
+    """
+    Which failed calls send() retries, and how long it waits between attempts (exponential backoff with jitter).
+    Transient errors are connection errors, timeouts, 5xx responses and responses which aren't the expected xml
+    (e.g. an html error page). Read (GET_*) operations are retried - others only if listed in retry_operations,
+    as retrying e.g. ADD_REQUEST could add it twice.
+    """
+    def __init__(self, max_attempts=3, backoff=0.5, max_backoff=30, deadline=60, retry_operations=(), on_retry=None):
+        """
+        :param max_attempts: attempts per call, including the first (1 to not retry)
+        :param backoff: seconds - the wait before attempt n is random, up to backoff * 2 ** (n - 2)
+        :param max_backoff: max seconds to wait between attempts
+        :param deadline: seconds - no attempt is started after this long since the first
+        :param retry_operations: non read operations which are safe to retry e.g. ['EDIT_REQUEST', 'ADD_NOTE']
+        :param on_retry: function called before each retry with (operation, attempt, error, delay)
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.retry_operations = set(retry_operations)
+        self.on_retry = on_retry
+
+    def retries(self, operation):
+        return operation.startswith('GET_') or operation in self.retry_operations
+
+    @staticmethod
+    def is_transient(error):
+        transient = (ET.ParseError, xml.parsers.expat.ExpatError)
+        if 'requests' in sys.modules:  # otherwise the error can't be from requests
+            transient += (requests.ConnectionError, requests.Timeout, requests.HTTPError)
+        if 'aiohttp' in sys.modules:
+            transient += (aiohttp.ClientError, asyncio.TimeoutError)
+        return isinstance(error, transient)
+
+    @staticmethod
+    def not_sent(error):
+        """
+        :return: True if error was raised before the call reached the server (it couldn't connect), so any
+        operation is safe to retry
+        """
+        if 'requests' in sys.modules:
+            if isinstance(error, requests.ConnectTimeout):
+                return True
+            if isinstance(error, requests.ConnectionError):
+                import urllib3.exceptions
+                reason = getattr(error.args[0] if error.args else None, 'reason', None)
+                return isinstance(reason, urllib3.exceptions.NewConnectionError)
+        return 'aiohttp' in sys.modules and isinstance(error, aiohttp.ClientConnectorError)
+
+    def delay(self, operation, attempt, error, elapsed):
+        """
+        :param operation: operation name
+        :param attempt: number of the attempt which failed, from 1
+        :param error: exception raised
+        :param elapsed: seconds since the first attempt started
+        :return: seconds to wait before retrying, or None to give up
+        """
+        if attempt >= self.max_attempts or not self.retries(operation) or not self.is_transient(error):
+            return None
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        if elapsed + delay > self.deadline:
+            return None
+        if self.on_retry:
+            self.on_retry(operation, attempt, error, delay)
+        return delay
+
+
+class Metrics:
+    """
+    Collects per operation call counts, bytes sent/received and time spent in each phase of a call:
+    build (making the xml), http (waiting for and downloading the response), parse (reading the xml),
+    xmltodict (reading bypass=True responses), postprocess (turning parsed responses into results) and total.
+    For send_records() the download is parsed as it arrives, so is counted under parse.
+    Thread safe - one instance can be shared by several API instances.
+    """
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, callback=None, buckets=default_buckets):
+        """
+        :param callback: function called with a dict for each finished call e.g. {'operation': 'GET_REQUEST',
+        'status': 'Success', 'attempts': 1, 'seconds': 0.05, 'phases': {'build': 0.0001, 'http': 0.04, ...},
+        'request_bytes': 0, 'response_bytes': 1024}. Status is the response status, 'ok' for responses without
+        one, 'error', or 'shared' for a call answered by another caller's identical call (single flight), with no
+        attempts or bytes. Post processing is reported separately, without status.
+        :param buckets: histogram bucket upper bounds, in seconds
+        """
+        self.callback = callback
+        self.buckets = tuple(buckets)
+        self.calls = collections.Counter()  # (operation, status): calls
+        self.bytes = collections.Counter()  # (operation, 'sent'/'received'): bytes
+        self.histograms = {}  # (operation, phase): [count per bucket..., count, sum]
+        self._lock = threading.Lock()
+
+    def record(self, call):
+        """
+        :param call: dict as given to callback
+        """
+        with self._lock:
+            if 'status' in call:
+                self.calls[call['operation'], call['status']] += 1
+                self.bytes[call['operation'], 'sent'] += call['request_bytes']
+                self.bytes[call['operation'], 'received'] += call['response_bytes']
+                self._observe(call['operation'], 'total', call['seconds'])
+            for phase, seconds in call['phases'].items():
+                self._observe(call['operation'], phase, seconds)
+        if self.callback:
+            self.callback(call)
+
+    def _observe(self, operation, phase, seconds):
+        histogram = self.histograms.get((operation, phase))
+        if histogram is None:
+            histogram = self.histograms[operation, phase] = [0] * (len(self.buckets) + 2)
+        histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram[-2] += 1
+        histogram[-1] += seconds
+
+    @contextlib.contextmanager
+    def time_phase(self, operation, phase):
+        """
+        Times a block as a phase of operation e.g. with metrics.time_phase('GET_ALL', 'postprocess'): ...
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record({'operation': operation, 'phases': {phase: time.perf_counter() - started}})
+
+    def prometheus(self):
+        """
+        :return: metrics in prometheus text exposition format
+        """
+        def labels(**values):
+            return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for name, value in values.items()) + '}'
+        with self._lock:
+            lines = ['# HELP sdplus_calls_total API calls by operation and response status',
+                     '# TYPE sdplus_calls_total counter']
+            lines += ['sdplus_calls_total{} {}'.format(labels(operation=operation, status=status), count)
+                      for (operation, status), count in sorted(self.calls.items())]
+            lines += ['# HELP sdplus_bytes_total Bytes sent (xml input) and received by operation',
+                      '# TYPE sdplus_bytes_total counter']
+            lines += ['sdplus_bytes_total{} {}'.format(labels(operation=operation, direction=direction), count)
+                      for (operation, direction), count in sorted(self.bytes.items())]
+            lines += ['# HELP sdplus_phase_seconds Time spent in each phase of a call',
+                      '# TYPE sdplus_phase_seconds histogram']
+            for (operation, phase), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), histogram):
+                    cumulative += count
+                    lines.append('sdplus_phase_seconds_bucket{} {}'.format(
+                        labels(operation=operation, phase=phase, le=bound), cumulative))
+                lines.append('sdplus_phase_seconds_sum{} {}'.format(
+                    labels(operation=operation, phase=phase), histogram[-1]))
+                lines.append('sdplus_phase_seconds_count{} {}'.format(
+                    labels(operation=operation, phase=phase), histogram[-2]))
+        return '\n'.join(lines) + '\n'
+
+
+class _CallTimer:
+    """
+    Times the phases of one call for Metrics
+    """
+    def __init__(self, metrics, operation):
+        self.metrics = metrics
+        self.call = {'operation': operation, 'status': 'error', 'attempts': 0, 'seconds': 0, 'phases': {},
+                     'request_bytes': 0, 'response_bytes': 0}
+        self._started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            phases = self.call['phases']
+            phases[name] = phases.get(name, 0) + time.perf_counter() - started
+
+    def add(self, key, value):
+        self.call[key] += value
+
+    def count_bytes(self, chunks):
+        for chunk in chunks:
+            self.call['response_bytes'] += len(chunk)
+            yield chunk
+
+    def done(self, result=None):
+        if isinstance(result, dict):
+            self.call['status'] = result.get('response_status', 'ok')
+        elif result is not None:
+            self.call['status'] = 'ok'
+        self.call['seconds'] = time.perf_counter() - self._started
+        self.metrics.record(self.call)
+
+    def shared(self):
+        """
+        Records a call answered by another caller's request (single flight), with status 'shared'
+        """
+        self.call['status'] = 'shared'
+        self.done()
+
+
+class _NoCallTimer:
+    """
+    Stands in for _CallTimer when metrics are off, doing nothing
+    """
+    _null_context = contextlib.nullcontext()
+
+    def phase(self, name):
+        return self._null_context
+
+    def add(self, key, value):
+        pass
+
+    def count_bytes(self, chunks):
+        return chunks
+
+    def done(self, result=None):
+        pass
+
+    def shared(self):
+        pass
+
+
+_no_call_timer = _NoCallTimer()
+
+
+def _xml_element(fields, sub_elements):
+    """
+    :param fields: dict of main values
+    :param sub_elements: elements to put between <Details> and <parameter>
+    :return: ET.Element of the request xml
+    """
+    operation = ET.Element('Operation')  # Standard as part of the API
+    details = ET.SubElement(operation, 'Details')  # Standard as part of the API
+    current_parent = details
+    for sub in sub_elements:
+        current_parent = ET.SubElement(current_parent, sub)
+    for key, value in fields.items():
+        param = ET.SubElement(current_parent, 'parameter')
+        ET.SubElement(param, 'name').text = key
+        ET.SubElement(param, 'value').text = value
+    return operation
+
+
+_XML_VALUE_SLOT = '\x00'
+
+
+@functools.lru_cache(maxsize=256)
+def _xml_template(names, sub_elements):
+    """
+    Request xml for a field set, serialised once by ElementTree and split where the values go
+    :param names: tuple of field names
+    :param sub_elements: tuple of elements to put between <Details> and <parameter>
+    :return: list of len(names) + 1 byte strings to put the values between, or None if names can't be templated
+    """
+    xml = ET.tostring(_xml_element(dict.fromkeys(names, _XML_VALUE_SLOT), sub_elements))
+    parts = xml.split(b'<value>' + _XML_VALUE_SLOT.encode() + b'</value>')
+    return parts if len(parts) == len(names) + 1 else None
+
+
+def _xml_value(value):
+    """
+    <value> element as ET.tostring() writes it: &, < and > escaped, non ascii as character references
+    """
+    if not value:
+        return b'<value />'
+    if '&' in value:
+        value = value.replace('&', '&amp;')
+    if '<' in value:
+        value = value.replace('<', '&lt;')
+    if '>' in value:
+        value = value.replace('>', '&gt;')
+    return b'<value>' + value.encode('ascii', 'xmlcharrefreplace') + b'</value>'
+
+
+class _SingleFlight:
+    """
+    Runs one call per key at a time: callers asking for a key already being fetched wait for that call instead of
+    making their own. Each caller gets its own deep copy of the result (or the exception) - the result the others
+    copy from is never handed out. Calls aren't remembered once finished.
+    """
+    def __init__(self):
+        self.shared = 0  # calls answered by another caller's request
+        self._lock = threading.Lock()
+        self._calls = {}  # key: [concurrent.futures.Future, callers waiting], for threads
+        self._tasks = {}  # key: [asyncio.Task, followers, callers waiting] - coroutines, used from the loop thread only
+
+    def call(self, key, function, timer=_no_call_timer):
+        """
+        :param key: hashable key - same key, same result
+        :param function: function to run, without arguments
+        :param timer: _CallTimer - a caller given another's result is recorded as status 'shared'
+        :return: function's result
+        """
+        with self._lock:
+            flight = self._calls.get(key)
+            if flight is None:
+                flight = self._calls[key] = [concurrent.futures.Future(), 0]
+                leader = True
+            else:
+                flight[1] += 1
+                self.shared += 1
+                leader = False
+        if not leader:
+            try:
+                return copy.deepcopy(flight[0].result())
+            finally:
+                timer.shared()
+        try:
+            result = function()
+        except BaseException as error:
+            with self._lock:
+                del self._calls[key]
+            flight[0].set_exception(error)
+            raise
+        with self._lock:
+            del self._calls[key]  # no more callers can join
+        # Waiting callers copy from a copy of their own, so this caller can change result straight away
+        flight[0].set_result(copy.deepcopy(result) if flight[1] else None)
+        return result
+
+    async def call_async(self, key, coroutine_function, timer=_no_call_timer):
+        """
+        As call(), for coroutines - a caller being cancelled doesn't cancel the call for the others, but the call is
+        cancelled once every caller waiting on it has been
+        """
+        flight = self._tasks.get(key)
+        leader = flight is None
+        if leader:
+            flight = self._tasks[key] = [asyncio.ensure_future(coroutine_function()), 0, 0]  # task, followers, waiting
+            flight[0].add_done_callback(lambda _: self._forget(key, flight))  # runs before any caller resumes
+        else:
+            flight[1] += 1
+            self.shared += 1
+        flight[2] += 1
+        try:
+            result = await asyncio.shield(flight[0])
+        finally:
+            flight[2] -= 1
+            if not flight[2] and not flight[0].done():
+                self._forget(key, flight)  # so later callers start a new call rather than join a cancelled one
+                flight[0].cancel()
+            if not leader:
+                timer.shared()
+        return copy.deepcopy(result) if flight[1] or not leader else result
+
+    def _forget(self, key, flight):
+        if self._tasks.get(key) is flight:
+            del self._tasks[key]
+
+
+class _MultipartUpload:
+    """
+    multipart/form-data body for one attachment, read in chunks as it is sent so large files aren't held in memory.
+    The source is a file path, a binary file object or an iterable of bytes, optionally as a (filename, source)
+    tuple. Files opened from a path are closed when sent or on close(); file objects are left open.
+    One instance is used for every attempt at a call. Paths, bytes and seekable files are sent in full each time;
+    other sources (iterators, pipes) can only be read once, so aren't rewindable and can't be retried.
+    """
+    chunk_size = 65536
+
+    def __init__(self, attachment):
+        filename, self.source = attachment if isinstance(attachment, tuple) else (None, attachment)
+        if filename is None:
+            name = self.source if isinstance(self.source, (str, os.PathLike)) else getattr(self.source, 'name', '')
+            filename = os.path.basename(name) if isinstance(name, (str, os.PathLike)) else ''
+        filename = str(filename or 'attachment').replace('"', '%22').replace('\r', '').replace('\n', '')
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + boundary
+        self._head = ('--{}\r\nContent-Disposition: form-data; name="file"; filename="{}"\r\n'
+                      'Content-Type: application/octet-stream\r\n\r\n').format(boundary, filename).encode('utf-8')
+        self._tail = '\r\n--{}--\r\n'.format(boundary).encode()
+        self._start = None
+        if hasattr(self.source, 'seek') and getattr(self.source, 'seekable', lambda: False)():
+            self._start = self.source.tell()  # so a retry can send the file again
+        size = self._size()
+        self.length = None if size is None else len(self._head) + size + len(self._tail)
+        self.rewindable = isinstance(self.source, (str, os.PathLike, bytes, bytearray, memoryview)) or (
+            self._start is not None)
+        self._read_once = False
+        self._chunks = None
+
+    def _size(self):
+        if isinstance(self.source, (str, os.PathLike)):
+            return os.path.getsize(self.source)
+        if isinstance(self.source, (bytes, bytearray, memoryview)):
+            return len(self.source)
+        if self._start is not None:
+            end = self.source.seek(0, os.SEEK_END)
+            self.source.seek(self._start)
+            return end - self._start
+        return None
+
+    def __iter__(self):
+        self._chunks = self._read()
+        return self._chunks
+
+    def _read(self):
+        if not self.rewindable:
+            if self._read_once:
+                raise ValueError('The attachment is an iterator or unseekable file, which was already read, so it '
+                                 "can't be sent again")
+            self._read_once = True
+        yield self._head
+        if isinstance(self.source, (str, os.PathLike)):
+            with open(self.source, 'rb') as file:
+                yield from iter(lambda: file.read(self.chunk_size), b'')
+        elif isinstance(self.source, (bytes, bytearray, memoryview)):
+            yield bytes(self.source)
+        elif hasattr(self.source, 'read'):
+            if self._start is not None:
+                self.source.seek(self._start)
+            yield from iter(lambda: self.source.read(self.chunk_size), b'')
+        else:
+            yield from self.source
+        yield self._tail
+
+    def close(self):
+        if self._chunks is not None:
+            self._chunks.close()
+
+    def __len__(self):
+        return self.length
+
+    def data(self):
+        """
+        :return: body for requests - itself when the length is known (sent with Content-Length), otherwise a
+        generator (sent chunked)
+        """
+        return self if self.length is not None else iter(self)
+
+    def headers(self):
+        headers = {'Content-Type': self.content_type}
+        if self.length is not None:
+            headers['Content-Length'] = str(self.length)
+        return headers
+
+
+class Record(collections.abc.MutableMapping):
+    """
+    Compact dict-like row from a record list response. Records with the same field names share one
+    {field name: position} index (with interned names), so each record only holds its list of values.
+    An index is never changed in place - adding or deleting a field gives that record its own, unshared index.
+    Fields named in _lazy_datetimes hold the epoch string until first read, then a datetime.
+    """
+    __slots__ = ('_index', '_values')
+    _lazy_datetimes = frozenset()
+    _indexes = {}  # (field names): {field name: position}
+    _max_indexes = 1024  # _indexes is emptied when full - records keep the index they have
+
+    def __init__(self, names=(), values=()):
+        """
+        :param names: field names, in order
+        :param values: field values, in the same order
+        """
+        names = tuple(names)
+        self._index = self._shared_index(names)
+        self._values = list(values)
+        if len(self._index) != len(names):  # repeated names - keep the last value, as a dict would
+            values = dict(zip(names, self._values))
+            self._index = self._shared_index(tuple(values))
+            self._values = list(values.values())
+
+    @classmethod
+    def from_dict(cls, fields):
+        return cls(fields.keys(), fields.values())
+
+    @staticmethod
+    def _shared_index(names):
+        index = Record._indexes.get(names)
+        if index is None:
+            index = {sys.intern(name) if isinstance(name, str) else name: position
+                     for position, name in enumerate(names)}
+            if len(Record._indexes) >= Record._max_indexes:
+                Record._indexes.clear()
+            Record._indexes[names] = index
+        return index
+
+    def __getitem__(self, key):
+        position = self._index[key]
+        value = self._values[position]
+        if key in self._lazy_datetimes and isinstance(value, str):
+            value = self._values[position] = API.epoch_to_datetime(value)
+        return value
+
+    def raw(self, key):
+        """
+        Value as parsed - without the datetime conversion of _lazy_datetimes, if not yet read
+        """
+        return self._values[self._index[key]]
+
+    def __setitem__(self, key, value):
+        if key not in self._index:
+            index = dict(self._index)
+            index[key] = len(index)
+            self._index = index
+            self._values.append(value)
+        else:
+            self._values[self._index[key]] = value
+
+    def __delitem__(self, key):
+        position = self._index[key]
+        self._index = {name: number for number, name in enumerate(name for name in self._index if name != key)}
+        del self._values[position]
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self))
+
+    def __getstate__(self):
+        return tuple(self._index), self._values
+
+    def __setstate__(self, state):
+        self._index = self._shared_index(state[0])
+        self._values = state[1]
+
+    def copy(self):
+        """
+        Shallow copy, as dict.copy() - the same type, sharing the index
+        """
+        record = type(self).__new__(type(self))
+        record._index = self._index
+        record._values = list(self._values)
+        return record
+
+    def to_dict(self):
+        return dict(self)
+
+
+class RequestRecord(Record):
+    """
+    Row from GET_REQUESTS - createdtime is read as a datetime
+    """
+    __slots__ = ()
+    _lazy_datetimes = frozenset(['createdtime'])
+
+
+class ConversationRecord(Record):
+    """
+    Row from GET_ALL_CONVERSATIONS - createddate is read as a datetime
+    """
+    __slots__ = ()
+    _lazy_datetimes = frozenset(['createddate'])
+
+
+class _RecordParser:
+    """
+    Incremental parser for API/response/operation/Details/record/parameter xml.
+    Gives the same list of dicts as output_params_to_list(xmltodict.parse(xml)), one record at a time,
+    without building the whole document
+    """
+    _records_path = ['API', 'response', 'operation', 'Details']
+
+    def __init__(self, record_type=dict):
+        """
+        :param record_type: dict, or a Record class
+        """
+        self._record_type = record_type
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._path = []
+        self._details = None
+        self._root = None
+
+    def feed(self, data):
+        """
+        :param data: next chunk of xml (bytes or str)
+        :return: list of records completed by this chunk
+        """
+        self._parser.feed(data)
+        return self._read_events()
+
+    def close(self):
+        self._parser.close()
+        records = self._read_events()
+        if self._root != 'API':  # e.g. an html error page
+            raise ET.ParseError('Expected API xml response, got <{}>'.format(self._root))
+        return records
+
+    @staticmethod
+    def _text(element):
+        # Matches xmltodict: surrounding whitespace stripped, empty as None
+        if element is None or not element.text:
+            return None
+        return element.text.strip() or None
+
+    def _read_events(self):
+        records = []
+        for event, element in self._parser.read_events():
+            if event == 'start':
+                if not self._path:
+                    self._root = element.tag
+                self._path.append(element.tag)
+                if self._path == self._records_path:
+                    self._details = element
+                continue
+            self._path.pop()
+            if element.tag == 'record' and self._path == self._records_path:
+                params = element.findall('parameter')
+                names = [self._text(param.find('name')) for param in params]
+                values = [self._text(param.find('value')) for param in params]
+                if self._record_type is dict:
+                    records.append(dict(zip(names, values)))
+                else:
+                    records.append(self._record_type(names, values))
+                self._details.clear()  # finished records aren't needed, so keep memory flat
+        return records
 
 
 class API:
@@ -16,14 +1002,125 @@ class API:
     The main sending class for the Manage Service Engine Rest API
     # https://www.manageengine.com/products/service-desk/help/adminguide/api/request-operations.html
     """
-    def __init__(self, api_key, api_url_base):
+    def __init__(self, api_key, api_url_base, timeout=(5, 60), pool_connections=10, pool_maxsize=10,
+                 max_in_flight=10, cache=None, rate_limit=None, operation_rate_limits=None, concurrency=None,
+                 retry=None, metrics=None, single_flight=True, versions=None):
         """
         Initiate values
         :param api_key: technician key
         :param api_url_base: should be base of sdplus api e.g. http://sdplus/sdpapi/
+        :param timeout: (connect, read) timeout in seconds for each call, or a single number for both
+        :param pool_connections: number of hosts to keep connection pools for
+        :param pool_maxsize: max keep-alive connections kept open per host
+        :param max_in_flight: max calls bulk() will have open against the server at once, across all bulk() runs
+        :param cache: TTLCache/DiskCache for technician and request filter lookups (default: 5 minute TTLCache) - can be
+        shared by APIs with different keys, as entries are kept per url and key
+        :param rate_limit: RateLimiter (or calls per second) for all calls
+        :param operation_rate_limits: {'operation name': RateLimiter (or calls per second)} e.g. {'ADD_REQUEST': 1}
+        applied on top of rate_limit
+        :param concurrency: AdaptiveConcurrency to limit calls open at once
+        :param retry: RetryPolicy for failed calls (default: RetryPolicy() - read operations tried up to 3 times)
+        :param metrics: Metrics to record calls to (default: off)
+        :param single_flight: True for identical GET_ calls made at the same time (e.g. from different threads) to
+        share one http request - each caller still gets its own copy of the result
+        :param versions: VersionStore for request_view_changed/request_get_new_conversations (default: a new one)
         """
         self.api_key = api_key
+        self._api_key_hash = None  # (api_key, hash) for _cache_key
         self.api_url_base = api_url_base
+        self.timeout = timeout
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.cache = TTLCache() if cache is None else cache
+        self.rate_limit = self._rate_limiter(rate_limit)
+        self.operation_rate_limits = {operation: self._rate_limiter(limit)
+                                      for operation, limit in (operation_rate_limits or {}).items()}
+        self.concurrency = concurrency
+        self.retry = RetryPolicy() if retry is None else retry
+        self.metrics = metrics
+        self.single_flight = _SingleFlight() if single_flight else None
+        self.versions = VersionStore() if versions is None else versions
+
+    def _cache_key(self, *key):
+        """
+        :return: cache key for this url and api key - the api key is hashed, as a DiskCache is a file on disk
+        """
+        if self._api_key_hash is None or self._api_key_hash[0] != self.api_key:
+            self._api_key_hash = (self.api_key, hashlib.blake2b(self.api_key.encode(), digest_size=16).hexdigest())
+        return (self.api_url_base, self._api_key_hash[1]) + key
+
+    @staticmethod
+    def _succeeded(response):
+        """
+        :param response: bypass=True response
+        :return: True if its result status is Success
+        """
+        try:
+            operation = response['operation'] if 'operation' in response else response['API']['response']['operation']
+            return operation['result']['status'] == 'Success'
+        except (KeyError, TypeError):
+            return False
+
+    @staticmethod
+    def _rate_limiter(limit):
+        if limit is None or isinstance(limit, RateLimiter):
+            return limit
+        return RateLimiter(limit)
+
+    def _timer(self, operation):
+        return _CallTimer(self.metrics, operation) if self.metrics else _no_call_timer
+
+    def _postprocess(self, operation):
+        return self.metrics.time_phase(operation, 'postprocess') if self.metrics else contextlib.nullcontext()
+
+    def _flight_key(self, url_append, operation, params, variant, attachment=''):
+        """
+        :param variant: anything else that changes the result e.g. bypass, record_type
+        :return: single flight key for a call, or None if it shouldn't be shared (single flight off, not a GET_)
+        """
+        if self.single_flight is None or attachment or not operation.startswith('GET_'):
+            return None
+        return url_append, operation, params.get('INPUT_DATA'), variant
+
+    def _rate_limiters(self, operation):
+        return [limit for limit in (self.rate_limit, self.operation_rate_limits.get(operation)) if limit]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def session(self):
+        """
+        Shared keep-alive session, created on first use. Connections are pooled per host and reused across calls
+        (and threads), so only the first call to a host pays for TCP/TLS setup.
+        :return: requests.Session
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_connections,
+                                                            pool_maxsize=self.pool_maxsize)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+        return self._session
+
+    def close(self):
+        """
+        Close the pooled session and its connections. The API can still be used afterwards - a new session is
+        created on the next call.
+        """
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
 
     @staticmethod
     def _create_xml(fields, sub_elements=None):
@@ -32,19 +1129,18 @@ class API:
         :param fields: dict of main values e.g.  {'isPublic': 'false', 'notesText': 'Simon Crouch'...}
         :param starting_element: string
         :param sub_elements: list of elements to put in xml between the default <Details> and <parameter>
-        :return:
+        :return: bytes - the structure for each set of field names is cached, so only the values are escaped per call
         """
-        sub_elements = [] if sub_elements is None else sub_elements
-        xml_string = ET.Element('Operation')  # Standard as part of the API
-        details = ET.SubElement(xml_string, 'Details')  # Standard as part of the API
-        current_parent = details
-        for sub in sub_elements:
-            current_parent = ET.SubElement(current_parent, sub)
-        for key, value in fields.items():
-            param = ET.SubElement(current_parent, 'parameter')
-            ET.SubElement(param, 'name').text = key
-            ET.SubElement(param, 'value').text = value
-        return ET.tostring(xml_string)
+        sub_elements = () if sub_elements is None else tuple(sub_elements)
+        values = list(fields.values())
+        template = _xml_template(tuple(fields), sub_elements)
+        if template is None or not all(value is None or type(value) is str for value in values):
+            return ET.tostring(_xml_element(fields, sub_elements))  # ElementTree's own errors for non str values
+        xml = [template[0]]
+        for value, part in zip(values, template[1:]):
+            xml.append(_xml_value(value))
+            xml.append(part)
+        return b''.join(xml)
 
     @staticmethod
     def output_params_to_list(response):
@@ -56,7 +1152,7 @@ class API:
         all_params = []
         try:
             records = response['API']['response']['operation']['Details']['record']
-        except KeyError:
+        except (KeyError, TypeError):  # TypeError: empty <Details/> parses to None
             return []
         if isinstance(records, dict):  # 1 record
             parameters_dict = {}
@@ -77,24 +1173,119 @@ class API:
         :param url_append: string to append to end of base API url e.g. 21 but not /21
         :param operation: operation name param as specified in ManageEngine API spec
         :param input_fields: dictionary of fields e.g. {'subject': 'EDITED ...' }
-        :param attachment: file path to attachment
+        :param attachment: attachment file path, binary file object or iterable of bytes - or (filename, any of those)
         :param sub_elements: list of elements to put in xml between the default <Details> and <parameter>
         :param bypass: True/False as to whether to bypass manual processing and use xmltodict module
         :return: {'response_key': 'response value', ...}
         """
+        timer = self._timer(operation)
+        with timer.phase('build'):
+            params = self._request_params(operation, input_fields, sub_elements)
+
+        def parse(response):
+            with timer.phase('http'):
+                response_text = response.text
+            timer.add('response_bytes', len(response.content))
+            with timer.phase('xmltodict' if bypass else 'parse'):
+                return self._parse_response(response_text, bypass)
+        key = self._flight_key(url_append, operation, params, ('send', bypass), attachment)
+        if key is not None:
+            return self.single_flight.call(
+                key, lambda: self._call(url_append, operation, params, parse, attachment, timer), timer)
+        return self._call(url_append, operation, params, parse, attachment, timer)
+
+    def _call(self, url_append, operation, params, parse, attachment='', timer=_no_call_timer):
+        """
+        Makes the http call, retrying as per self.retry
+        :param url_append: string to append to end of base API url e.g. 21 but not /21
+        :param operation: operation name param as specified in ManageEngine API spec
+        :param params: query string parameters from _request_params
+        :param parse: function taking the (streamed) requests response and returning the result
+        :param attachment: attachment as for send()
+        :param timer: _CallTimer for metrics
+        :return: result of parse
+        """
+        url = urllib.parse.urljoin(self.api_url_base, url_append)
+        timer.add('request_bytes', len(params.get('INPUT_DATA', b'')))
+        started = time.monotonic()
+        attempt = 1
+        result = None
+        try:
+            body = _MultipartUpload(attachment) if attachment else None  # one body for every attempt
+            while True:
+                timer.add('attempts', 1)
+                try:
+                    result = self._attempt(url, operation, params, parse, body, timer)
+                    return result
+                except Exception as e:
+                    if body is not None and not body.rewindable:  # already used up - retrying would send less
+                        raise
+                    delay = self.retry.delay(operation, attempt, e, time.monotonic() - started)
+                    if delay is None:
+                        raise
+                time.sleep(delay)
+                attempt += 1
+        finally:
+            timer.done(result)
+
+    def _attempt(self, url, operation, params, parse, body=None, timer=_no_call_timer):
+        """
+        Makes one http call, applying any rate limits and concurrency limit - see _call
+        :param body: _MultipartUpload for an attachment
+        """
+        for limit in self._rate_limiters(operation):
+            limit.acquire()
+        if self.concurrency:
+            self.concurrency.acquire()
+        started = time.monotonic()
+        failed = True
+        try:
+            with timer.phase('http'):
+                if body is not None:
+                    try:
+                        response = self.session.post(url, params=params, data=body.data(),
+                                                     headers={'Content-Type': body.content_type},
+                                                     timeout=self.timeout, stream=True)
+                    finally:
+                        body.close()
+                else:
+                    response = self.session.get(url, params=params, timeout=self.timeout, stream=True)
+            with response:
+                if response.status_code >= 500:
+                    response.raise_for_status()
+                result = parse(response)
+            failed = False
+            return result
+        finally:
+            if self.concurrency:
+                self.concurrency.release(time.monotonic() - started, failed)
+
+    def _request_params(self, operation, input_fields=None, sub_elements=None):
+        """
+        Query string parameters for a call
+        :param operation: operation name param as specified in ManageEngine API spec
+        :param input_fields: dictionary of fields e.g. {'subject': 'EDITED ...' }
+        :param sub_elements: list of elements to put in xml between the default <Details> and <parameter>
+        :return: {'TECHNICIAN_KEY': ..., 'OPERATION_NAME': ..., 'INPUT_DATA': ...}
+        """
         sub_elements = [] if sub_elements is None else sub_elements
         params = {'TECHNICIAN_KEY': self.api_key,
                   'OPERATION_NAME': operation}
         if input_fields:
             xml_input = self._create_xml(input_fields, sub_elements)
             params.update({'INPUT_DATA': xml_input})
-        if attachment:
-            file = {'file': open(attachment, 'rb')}
-            response_text = requests.post(urllib.parse.urljoin(self.api_url_base, url_append), params=params, files=file).text
-        else:
-            response_text = requests.get(urllib.parse.urljoin(self.api_url_base, url_append), params).text
+        return params
+
+    @staticmethod
+    def _parse_response(response_text, bypass=False):
+        """
+        Turns the xml returned by the API into a dict
+        :param response_text: xml response body
+        :param bypass: True/False as to whether to bypass manual processing and use xmltodict module
+        :return: {'response_key': 'response value', ...}
+        """
         if bypass:  # needed when xml response is more complex
-            return json.loads(json.dumps(xmltodict.parse(response_text)))
+            return xmltodict.parse(response_text, dict_constructor=dict)
         response = ET.fromstring(response_text)
         result = {}
         for status_item in response.iter('result'):
@@ -102,6 +1293,8 @@ class API:
                 'response_status': status_item.find('status').text,
                 'response_message': status_item.find('message').text
             }
+        if not result:  # well formed, but not an API response e.g. an xhtml error page
+            raise ET.ParseError('Expected API xml response with a <result>, got <{}>'.format(response.tag))
         if result['response_status'] == 'Success':
             for param_tags in response.iter('Details'):
                 # Assumes xml: parameter, name & value
@@ -111,6 +1304,81 @@ class API:
                                         if details_params is not None]))
         return result
 
+    def send_records(self, url_append, operation, input_fields=None, sub_elements=None, record_type=dict):
+        """
+        Send through details into API, for operations which return a list of records (e.g. GET_REQUESTS)
+        The response is parsed as it downloads - same result as output_params_to_list(send(..., bypass=True))
+        :param url_append: string to append to end of base API url e.g. 21 but not /21
+        :param operation: operation name param as specified in ManageEngine API spec
+        :param input_fields: dictionary of fields e.g. {'from': '0', 'limit': '100' }
+        :param sub_elements: list of elements to put in xml between the default <Details> and <parameter>
+        :param record_type: dict, or a Record class for compact rows
+        :return: list: [{'key': 'value'}, {'key': 'value'}, ...
+        """
+        timer = self._timer(operation)
+        with timer.phase('build'):
+            params = self._request_params(operation, input_fields, sub_elements)
+
+        def parse(response):
+            with timer.phase('parse'):
+                return list(self.iter_records(timer.count_bytes(response.iter_content(chunk_size=65536)), record_type))
+        key = self._flight_key(url_append, operation, params, ('send_records', record_type))
+        if key is not None:
+            return self.single_flight.call(
+                key, lambda: self._call(url_append, operation, params, parse, timer=timer), timer)
+        return self._call(url_append, operation, params, parse, timer=timer)
+
+    @staticmethod
+    def iter_records(response_xml, record_type=dict):
+        """
+        Yields each record of a record list response as a dict, parsing incrementally
+        :param response_xml: xml as str/bytes, or an iterable of str/bytes chunks
+        :param record_type: dict, or a Record class for compact rows
+        :return: generator of {'key': 'value'} dicts
+        """
+        if isinstance(response_xml, (str, bytes)):
+            # Fed in chunks, so finished records are dropped as it goes rather than the whole tree being built first
+            response_xml = [response_xml[start:start + 65536] for start in range(0, len(response_xml), 65536)]
+        parser = _RecordParser(record_type)
+        for chunk in response_xml:
+            yield from parser.feed(chunk)
+        yield from parser.close()
+
+    def bulk(self, operation, iterable_of_args, max_workers=8):
+        """
+        Run one operation over many inputs concurrently, yielding results as they finish (not in input order)
+        e.g. for r in api.bulk(api.note_add, [('184699', 'False', 'text'), ...]): print(r.args, r.result, r.error)
+        :param operation: API method (e.g. api.request_close) or its name (e.g. 'request_close')
+        :param iterable_of_args: each item is a tuple of positional args, a dict of keyword args, or a single arg
+        :param max_workers: threads used by this run - calls are also capped by max_in_flight across all runs
+        :return: generator of BulkResult(args, result, error) - error is the exception raised, or None
+        """
+        if isinstance(operation, str):
+            operation = getattr(self, operation)
+
+        def call(args):
+            with self._in_flight:
+                if isinstance(args, dict):
+                    return operation(**args)
+                if isinstance(args, tuple):
+                    return operation(*args)
+                return operation(args)
+
+        args_iter = iter(iterable_of_args)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {}
+            # Only keep a couple of items per worker queued, so huge/lazy inputs aren't read in all at once
+            for args in itertools.islice(args_iter, max_workers * 2):
+                pending[executor.submit(call, args)] = args
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    args = pending.pop(future)
+                    error = future.exception()
+                    yield BulkResult(args, None if error else future.result(), error)
+                for args in itertools.islice(args_iter, len(done)):
+                    pending[executor.submit(call, args)] = args
+
     # Request Operations
     def request_add(self, fields):
         return self.send('request/', 'ADD_REQUEST', fields)
@@ -121,6 +1389,42 @@ class API:
     def request_view(self, request_id):
         return self.send('request/' + request_id, 'GET_REQUEST')
 
+    def request_view_changed(self, request_id):
+        """
+        As request_view, but only parses the response if it differs from the last one seen for this request (by
+        request_view_changed, in self.versions) - for polling many requests which mostly haven't changed
+        :return: request_view result, or None if unchanged
+        """
+        timer = self._timer('GET_REQUEST')
+        with timer.phase('build'):
+            params = self._request_params('GET_REQUEST')
+        key = ('GET_REQUEST', request_id)
+
+        def parse(response):
+            with timer.phase('http'):
+                content = response.content
+            timer.add('response_bytes', len(content))
+            return self._parse_if_changed(key, content, lambda: self._parse_response(response.text), timer)
+        changed, result = self._call('request/' + request_id, 'GET_REQUEST', params, parse, timer=timer)
+        return result if changed else None
+
+    def _parse_if_changed(self, key, content, parse, timer):
+        """
+        :return: (False, None) if content is the version last seen for key, else (True, parse())
+        """
+        version = self.versions.digest(content)
+        previous = self.versions.get(key)
+        if previous == version:
+            return False, None
+        with timer.phase('parse'):
+            result = parse()
+        if result.get('response_status') == 'Success':  # failures are returned every time
+            while not self.versions.compare_and_set(key, previous, version):
+                previous = self.versions.get(key)
+                if previous == version:  # another call returned this version meanwhile
+                    return False, None
+        return True, result
+
     def request_delete(self, request_id):
         return self.send('request/' + request_id, 'DELETE_REQUEST')
 
@@ -140,15 +1444,29 @@ class API:
         return self.send('request/' + request_id, 'CLOSE_REQUEST', fields)
 
     def request_get_conversations(self, request_id):
-        result = self.send('request/' + request_id + '/conversation', 'GET_CONVERSATIONS', bypass=True)
-        return self.output_params_to_list(result)
+        return self.send_records('request/' + request_id + '/conversation', 'GET_CONVERSATIONS')
 
     def request_get_conversation(self, request_id, conversation_id):
-        result = self.send('request/' + request_id + '/conversation/' + conversation_id, 'GET_CONVERSATION', bypass=True)
-        return self.output_params_to_list(result)
+        return self.send_records('request/' + request_id + '/conversation/' + conversation_id, 'GET_CONVERSATION')
 
-    def request_add_attachment(self, request_id, attachment_path):
-        return self.send('request/' + request_id + '/attachment', 'ADD_ATTACHMENT', attachment=attachment_path)
+    def request_add_attachment(self, request_id, attachment):
+        """
+        :param request_id: id of request
+        :param attachment: file path, binary file object or iterable of bytes - or (filename, any of those)
+        :return: response
+        """
+        return self.send('request/' + request_id + '/attachment', 'ADD_ATTACHMENT', attachment=attachment)
+
+    def request_add_attachments(self, attachments, max_workers=4):
+        """
+        Uploads many attachments concurrently - see bulk()
+        e.g. api.request_add_attachments(itertools.product(['184699', '184700'], ['log.zip', 'screenshot.png']))
+        Use paths (not file objects or iterators) to upload the same file to several requests
+        :param attachments: iterable of (request_id, attachment) - attachment as for request_add_attachment()
+        :param max_workers: uploads at once
+        :return: generator of BulkResult((request_id, attachment), result, error)
+        """
+        return self.bulk(self.request_add_attachment, (tuple(pair) for pair in attachments), max_workers)
 
     def request_adding_resolution(self, request_id, text=''):
         return self.send('request/' + request_id + '/resolution', 'ADD_RESOLUTION', {'resolutiontext': text}, sub_elements='resolution')
@@ -177,7 +1495,7 @@ class API:
     def request_get_requests(self, filter_by='All_Requests', limit='1000', frm='0'):
         """
         Get all call details from sdplus - works by returning MOST RECENT calls first
-        Will translate epoch createdtime to datetime object
+        Will translate epoch createdtime to datetime object (when first read)
         :param filter_by: Queue name (not value) to search - seems to return only OPEN calls
         :param frm: 0=most recent logged call, ... 10=10th oldest call from present etc.
         :param limit: limit returned results
@@ -188,11 +1506,41 @@ class API:
         """
         # api = API(os.environ['SDPLUS_ADMIN'], 'http://sdplus/sdpapi/request/')
         fields = {'from': frm, 'limit': limit, 'filterby': filter_by}
-        calls_from_sdplus = self.send('request/', 'GET_REQUESTS', fields, bypass=True)
-        calls_from_sdplus = self.output_params_to_list(calls_from_sdplus)
-        for call in calls_from_sdplus:
-            call['createdtime'] = self.epoch_to_datetime(call['createdtime'])
-        return calls_from_sdplus
+        return self.send_records('request/', 'GET_REQUESTS', fields, record_type=RequestRecord)
+
+    def iter_requests(self, filter_by='All_Requests', page_size=100, prefetch=False):
+        """
+        Generator over all calls in a queue, fetching one page of GET_REQUESTS at a time (MOST RECENT calls first)
+        Yields the same dicts as request_get_requests()
+        :param filter_by: Queue name (not value) to search - seems to return only OPEN calls
+        :param page_size: calls fetched per page
+        :param prefetch: True to fetch the next page in the background while the current page is being used
+        :return: generator of dicts for each call
+        """
+        frm = 0
+        if not prefetch:
+            while True:
+                page = self.request_get_requests(filter_by, str(page_size), str(frm))
+                yield from page
+                if len(page) < page_size:
+                    return
+                frm += page_size
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        next_page = None
+        try:
+            next_page = executor.submit(self.request_get_requests, filter_by, str(page_size), str(frm))
+            while True:
+                page, next_page = next_page.result(), None
+                frm += page_size
+                if len(page) == page_size:
+                    next_page = executor.submit(self.request_get_requests, filter_by, str(page_size), str(frm))
+                yield from page
+                if len(page) < page_size:
+                    return
+        finally:  # stopped early - don't wait for the prefetch (one already downloading finishes unused)
+            if next_page is not None:
+                next_page.cancel()
+            executor.shutdown(wait=False)
 
     def request_get_notification(self, request_id, notification_id):
         return self.send('request/' + request_id + '/notification/' + notification_id, 'GET_NOTIFICATION', bypass=True)
@@ -201,15 +1549,61 @@ class API:
         return self.send('request/' + request_id + '/notification/', 'GET_NOTIFICATIONS', bypass=True)
 
     def request_get_all_conversations(self, request_id):
-        all_conversations = self.send('request/' + request_id + '/allconversation/', 'GET_ALL_CONVERSATIONS', bypass=True)
-        all_conversations = self.output_params_to_list(all_conversations)
-        for conversation in all_conversations:
-            conversation['createddate'] = self.epoch_to_datetime(conversation['createddate'])
-        return all_conversations
+        return self.send_records('request/' + request_id + '/allconversation/', 'GET_ALL_CONVERSATIONS',
+                                 record_type=ConversationRecord)
+
+    def request_get_new_conversations(self, request_id):
+        """
+        As request_get_all_conversations, but only conversations newer than the newest returned for this request
+        last time (kept in self.versions). The response isn't parsed at all if it hasn't changed.
+        :return: list of ConversationRecords - all of them on the first call for a request
+        """
+        timer = self._timer('GET_ALL_CONVERSATIONS')
+        with timer.phase('build'):
+            params = self._request_params('GET_ALL_CONVERSATIONS')
+        key = ('GET_ALL_CONVERSATIONS', request_id)
+
+        def parse(response):
+            with timer.phase('http'):
+                content = response.content
+            timer.add('response_bytes', len(content))
+            return self._new_conversations(key, content)
+        return self._call('request/' + request_id + '/allconversation/', 'GET_ALL_CONVERSATIONS', params, parse,
+                          timer=timer)
+
+    def _new_conversations(self, key, content):
+        """
+        :return: conversations in content newer than the newest seen for key
+        """
+        version = self.versions.digest(content)
+        records = None
+        while True:  # again if another call for this request updated its version meanwhile
+            stored = self.versions.get(key)
+            seen, newest = stored or (None, None)
+            if seen == version:
+                return []
+            if records is None:
+                records = list(self.iter_records(content, ConversationRecord))
+            conversations = []
+            latest = newest
+            for conversation in records:
+                created = _epoch_ms(conversation.raw('createddate'))
+                if newest is None or created > newest:
+                    conversations.append(conversation)
+                    latest = created if latest is None else max(latest, created)
+            if self.versions.compare_and_set(key, stored, (version, latest)):
+                return conversations
 
     def request_get_request_filters(self):
         # WARNING: request_get_request_filters() DOESN'T RETURN ALL FILTERS! EXCELLENT(!) API BROKEN.
-        return self.send('request/', 'GET_REQUEST_FILTERS', bypass=True)
+        # Cached - see self.cache
+        key = self._cache_key('GET_REQUEST_FILTERS')
+        filters = self.cache.get(key)
+        if filters is None:
+            filters = self.send('request/', 'GET_REQUEST_FILTERS', bypass=True)
+            if self._succeeded(filters):  # a failure is asked again next time
+                self.cache.set(key, filters)
+        return copy.deepcopy(filters)  # callers can change their copy without changing the cached one
 
     # Notes Related Operations
     def note_add(self, request_id, is_public='False', text=''):
@@ -231,8 +1625,26 @@ class API:
 
     # Technician Operations
     def technician_get_all(self, site_name='', group_id=''):
-        fields = {'siteName': site_name, 'groupid': group_id}
-        people_raw = self.send('technician/', 'GET_ALL', fields, bypass=True)
+        """
+        Cached - see self.cache
+        :return: {'full name': 'technician id', ...}
+        """
+        key = self._cache_key('GET_ALL', site_name, group_id)
+        people = self.cache.get(key)
+        if people is None:
+            fields = {'siteName': site_name, 'groupid': group_id}
+            people_raw = self.send('technician/', 'GET_ALL', fields, bypass=True)
+            with self._postprocess('GET_ALL'):
+                people = self._technicians_to_dict(people_raw)
+            self.cache.set(key, people)
+        return dict(people)
+
+    @staticmethod
+    def _technicians_to_dict(people_raw):
+        """
+        :param people_raw: bypass response from GET_ALL technicians
+        :return: {'full name': 'technician id', ...}
+        """
         people = {}
         for record in people_raw['API']['response']['operation']['Details']['record']:
             people[record['parameter'][1]['value']] = record['parameter'][0]['value']
@@ -258,6 +1670,16 @@ class API:
         :return: [{'name': 'displayed queue name', 'id': 'queue id in sdplus'}, ...]
         """
         filters = self.request_get_request_filters()
+        with self._postprocess('GET_REQUEST_FILTERS'):
+            return self._queue_ids(filters, queue_name_list)
+
+    @staticmethod
+    def _queue_ids(filters, queue_name_list):
+        """
+        :param filters: bypass response from GET_REQUEST_FILTERS
+        :param queue_name_list: [displayed queue names]
+        :return: [{'name': 'displayed queue name', 'id': 'queue id in sdplus'}, ...]
+        """
         sdplus_queue_value_name = filters['operation']['Details']['Filters']['parameter']  # value=display, name=id
         queues_all = []
         queue = {}
@@ -273,3 +1695,1271 @@ class API:
     @staticmethod
     def epoch_to_datetime(epoch):
         return datetime.datetime.fromtimestamp(float(epoch) / 1000)
+
+
+class AsyncAPI(API):
+    """
+    asyncio version of API, sharing its xml building and parsing. Needs the aiohttp module.
+    All API methods are available and must be awaited e.g. result = await api.request_view('154594')
+    """
+    def __init__(self, api_key, api_url_base, timeout=(5, 60), pool_connections=10, pool_maxsize=100,
+                 max_in_flight=100, **kwargs):
+        """
+        Initiate values - as API. pool_maxsize is the max open connections per host, and at most
+        pool_connections * pool_maxsize connections are open overall (pool_connections=0 for no overall limit)
+        """
+        import importlib.util
+        if 'aiohttp' not in sys.modules and importlib.util.find_spec('aiohttp') is None:
+            raise ImportError('AsyncAPI requires the aiohttp module')
+        super().__init__(api_key, api_url_base, timeout, pool_connections, pool_maxsize, max_in_flight, **kwargs)
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+
+    def __enter__(self):
+        raise TypeError('AsyncAPI needs async with, not with')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    @property
+    def session(self):
+        """
+        Shared aiohttp session, created on first use inside the running event loop
+        :return: aiohttp.ClientSession
+        """
+        if self._session is None or self._session.closed:
+            connect, read = self.timeout if isinstance(self.timeout, tuple) else (self.timeout, self.timeout)
+            limit = self.pool_connections * self.pool_maxsize if self.pool_connections else 0
+            connector = aiohttp.TCPConnector(limit=limit, limit_per_host=self.pool_maxsize)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def send(self, url_append, operation, input_fields=None, attachment='', sub_elements=None, bypass=False):
+        """
+        Send through details into API - see API.send
+        """
+        timer = self._timer(operation)
+        with timer.phase('build'):
+            params = self._request_params(operation, input_fields, sub_elements)
+
+        async def parse(response):
+            with timer.phase('http'):
+                response_text = await response.text()
+            timer.add('response_bytes', len(await response.read()))
+            with timer.phase('xmltodict' if bypass else 'parse'):
+                return self._parse_response(response_text, bypass)
+        key = self._flight_key(url_append, operation, params, ('send', bypass), attachment)
+        if key is not None:
+            return await self.single_flight.call_async(
+                key, lambda: self._call(url_append, operation, params, parse, attachment, timer), timer)
+        return await self._call(url_append, operation, params, parse, attachment, timer)
+
+    async def send_records(self, url_append, operation, input_fields=None, sub_elements=None, record_type=dict):
+        """
+        Send through details into API, for operations which return a list of records - see API.send_records
+        """
+        timer = self._timer(operation)
+        with timer.phase('build'):
+            params = self._request_params(operation, input_fields, sub_elements)
+
+        async def parse(response):
+            with timer.phase('parse'):
+                parser = _RecordParser(record_type)
+                records = []
+                async for chunk in response.content.iter_chunked(65536):
+                    timer.add('response_bytes', len(chunk))
+                    records.extend(parser.feed(chunk))
+                records.extend(parser.close())
+                return records
+        key = self._flight_key(url_append, operation, params, ('send_records', record_type))
+        if key is not None:
+            return await self.single_flight.call_async(
+                key, lambda: self._call(url_append, operation, params, parse, timer=timer), timer)
+        return await self._call(url_append, operation, params, parse, timer=timer)
+
+    async def _call(self, url_append, operation, params, parse, attachment='', timer=_no_call_timer):
+        """
+        Makes the http call, retrying as per self.retry - see API._call
+        :param parse: coroutine function taking the aiohttp response and returning the result
+        """
+        if 'INPUT_DATA' in params:
+            params['INPUT_DATA'] = params['INPUT_DATA'].decode()
+            timer.add('request_bytes', len(params['INPUT_DATA']))
+        url = urllib.parse.urljoin(self.api_url_base, url_append)
+        started = time.monotonic()
+        attempt = 1
+        result = None
+        try:
+            body = _MultipartUpload(attachment) if attachment else None  # one body for every attempt
+            while True:
+                timer.add('attempts', 1)
+                try:
+                    result = await self._attempt(url, operation, params, parse, body, timer)
+                    return result
+                except Exception as e:
+                    if body is not None and not body.rewindable:
+                        raise
+                    delay = self.retry.delay(operation, attempt, e, time.monotonic() - started)
+                    if delay is None:
+                        raise
+                await asyncio.sleep(delay)
+                attempt += 1
+        finally:
+            timer.done(result)
+
+    async def _attempt(self, url, operation, params, parse, body=None, timer=_no_call_timer):
+        """
+        Makes one http call, applying any rate limits and concurrency limit - see API._call
+        """
+        for limit in self._rate_limiters(operation):
+            wait = limit.reserve()
+            if wait:
+                await asyncio.sleep(wait)
+        if self.concurrency:
+            await self.concurrency.acquire_async()
+        started = time.monotonic()
+        failed = True
+        try:
+            if body is not None:
+                try:
+                    with timer.phase('http'):
+                        response = await self.session.post(url, params=params, data=self._chunks(body),
+                                                           headers=body.headers())
+                finally:
+                    body.close()
+                async with response:
+                    result = await self._read(response, parse)
+            else:
+                with timer.phase('http'):
+                    response = await self.session.get(url, params=params)
+                async with response:
+                    result = await self._read(response, parse)
+            failed = False
+            return result
+        finally:
+            if self.concurrency:
+                self.concurrency.release(time.monotonic() - started, failed)
+
+    @staticmethod
+    async def _chunks(body):
+        # File reads run in the default executor, so slow disks don't block the event loop
+        loop = asyncio.get_running_loop()
+        chunks = iter(body)
+        while True:
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    @staticmethod
+    async def _read(response, parse):
+        if response.status >= 500:
+            response.raise_for_status()
+        return await parse(response)
+
+    async def bulk(self, operation, iterable_of_args, max_workers=8):
+        """
+        Run one operation over many inputs concurrently, yielding results as they finish - see API.bulk
+        e.g. async for r in api.bulk('request_close', ['184699', ...]): print(r.args, r.result, r.error)
+        :param max_workers: max calls open at once for this run - calls are also capped by max_in_flight
+        """
+        if isinstance(operation, str):
+            operation = getattr(self, operation)
+
+        async def call(args):
+            async with self._in_flight:
+                try:
+                    if isinstance(args, dict):
+                        result = await operation(**args)
+                    elif isinstance(args, tuple):
+                        result = await operation(*args)
+                    else:
+                        result = await operation(args)
+                except Exception as e:
+                    return BulkResult(args, None, e)
+                return BulkResult(args, result, None)
+
+        args_iter = iter(iterable_of_args)
+        pending = {asyncio.ensure_future(call(args)) for args in itertools.islice(args_iter, max_workers)}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+                for args in itertools.islice(args_iter, len(done)):
+                    pending.add(asyncio.ensure_future(call(args)))
+        finally:  # stopped early - don't leave calls running
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    # Operations which post process their response
+    async def request_get_conversations(self, request_id):
+        return await self.send_records('request/' + request_id + '/conversation', 'GET_CONVERSATIONS')
+
+    async def request_get_conversation(self, request_id, conversation_id):
+        return await self.send_records('request/' + request_id + '/conversation/' + conversation_id,
+                                       'GET_CONVERSATION')
+
+    async def request_get_requests(self, filter_by='All_Requests', limit='1000', frm='0'):
+        fields = {'from': frm, 'limit': limit, 'filterby': filter_by}
+        return await self.send_records('request/', 'GET_REQUESTS', fields, record_type=RequestRecord)
+
+    async def iter_requests(self, filter_by='All_Requests', page_size=100, prefetch=False):
+        """
+        Async generator over all calls in a queue, one page at a time - see API.iter_requests
+        e.g. async for call in api.iter_requests('All_Requests', 500): ...
+        """
+        frm = 0
+        next_page = None  # prefetch task
+        try:
+            while True:
+                if next_page is None:
+                    page = await self.request_get_requests(filter_by, str(page_size), str(frm))
+                else:
+                    page, next_page = await next_page, None
+                frm += page_size
+                if prefetch and len(page) == page_size:
+                    next_page = asyncio.ensure_future(self.request_get_requests(filter_by, str(page_size), str(frm)))
+                for call in page:
+                    yield call
+                if len(page) < page_size:
+                    return
+        finally:  # stopped early - don't leave the prefetch running
+            if next_page is not None and not next_page.cancel() and not next_page.cancelled():
+                next_page.exception()  # already finished - retrieve any error, so it isn't logged as unretrieved
+
+    async def request_get_all_conversations(self, request_id):
+        return await self.send_records('request/' + request_id + '/allconversation/', 'GET_ALL_CONVERSATIONS',
+                                       record_type=ConversationRecord)
+
+    async def request_view_changed(self, request_id):
+        """
+        As API.request_view_changed
+        """
+        timer = self._timer('GET_REQUEST')
+        with timer.phase('build'):
+            params = self._request_params('GET_REQUEST')
+        key = ('GET_REQUEST', request_id)
+
+        async def parse(response):
+            with timer.phase('http'):
+                content = await response.read()
+            timer.add('response_bytes', len(content))
+            return self._parse_if_changed(
+                key, content, lambda: self._parse_response(content.decode(response.get_encoding())), timer)
+        changed, result = await self._call('request/' + request_id, 'GET_REQUEST', params, parse, timer=timer)
+        return result if changed else None
+
+    async def request_get_new_conversations(self, request_id):
+        """
+        As API.request_get_new_conversations
+        """
+        timer = self._timer('GET_ALL_CONVERSATIONS')
+        with timer.phase('build'):
+            params = self._request_params('GET_ALL_CONVERSATIONS')
+        key = ('GET_ALL_CONVERSATIONS', request_id)
+
+        async def parse(response):
+            with timer.phase('http'):
+                content = await response.read()
+            timer.add('response_bytes', len(content))
+            return self._new_conversations(key, content)
+        return await self._call('request/' + request_id + '/allconversation/', 'GET_ALL_CONVERSATIONS', params,
+                                parse, timer=timer)
+
+    async def request_get_request_filters(self):
+        key = self._cache_key('GET_REQUEST_FILTERS')
+        filters = self.cache.get(key)
+        if filters is None:
+            filters = await self.send('request/', 'GET_REQUEST_FILTERS', bypass=True)
+            if self._succeeded(filters):
+                self.cache.set(key, filters)
+        return copy.deepcopy(filters)
+
+    async def technician_get_all(self, site_name='', group_id=''):
+        key = self._cache_key('GET_ALL', site_name, group_id)
+        people = self.cache.get(key)
+        if people is None:
+            fields = {'siteName': site_name, 'groupid': group_id}
+            people_raw = await self.send('technician/', 'GET_ALL', fields, bypass=True)
+            with self._postprocess('GET_ALL'):
+                people = self._technicians_to_dict(people_raw)
+            self.cache.set(key, people)
+        return dict(people)
+
+    async def request_assign_name(self, full_name, request_id):
+        names = await self.technician_get_all()
+        technician_id = names.get(full_name)
+        return await self.request_assign(request_id, technician_id)
+
+    async def get_queue_ids(self, queue_name_list: list):
+        filters = await self.request_get_request_filters()
+        with self._postprocess('GET_REQUEST_FILTERS'):
+            return self._queue_ids(filters, queue_name_list)
+
+
+class RequestMirror:
+    """
+    Local sqlite copy of a queue's requests, with their details, conversations and notes, for reporting.
+    After the first sync(), details are only downloaded for requests which are new, have changed in the queue list or
+    have left the queue (e.g. closed), and every full_refresh_every syncs for all requests in the queue, to pick up
+    conversations and notes, which don't change the queue list. Then reports are local queries e.g.
+    mirror.query('SELECT technician, COUNT(*) AS calls FROM requests WHERE active = 1 GROUP BY technician')
+    Tables: requests (workorderid, createdtime, status, technician, requester, subject, active, last_seen, synced,
+    summary = queue list values as json, details = request_view() as json), conversations (workorderid,
+    createddate, data = json), notes (workorderid, data = GET_NOTES Details as json), sync_state (key, value)
+    Times (createdtime, createddate) are epoch milliseconds, last_seen/synced epoch seconds
+    """
+    def __init__(self, api, path, filter_by='All_Requests', full_refresh_every=10):
+        """
+        :param api: API instance
+        :param path: sqlite file path e.g. 'sdplus_mirror.db'
+        :param filter_by: Queue name (not value) to mirror
+        :param full_refresh_every: download every request in the queue again every this many syncs (not counting
+        new_only syncs), 0 for never
+        """
+        self.api = api
+        self.path = path
+        self.filter_by = filter_by
+        self.full_refresh_every = full_refresh_every
+        with _sqlite_connect(self.path) as db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS requests (workorderid INTEGER PRIMARY KEY, createdtime INTEGER,
+                    status TEXT, technician TEXT, requester TEXT, subject TEXT, active INTEGER, last_seen REAL,
+                    synced REAL, summary TEXT, details TEXT);
+                CREATE INDEX IF NOT EXISTS requests_createdtime ON requests (createdtime);
+                CREATE INDEX IF NOT EXISTS requests_status ON requests (status, technician);
+                CREATE INDEX IF NOT EXISTS requests_technician ON requests (technician);
+                CREATE TABLE IF NOT EXISTS conversations (workorderid INTEGER, createddate INTEGER, data TEXT);
+                CREATE INDEX IF NOT EXISTS conversations_workorderid ON conversations (workorderid, createddate);
+                CREATE TABLE IF NOT EXISTS notes (workorderid INTEGER PRIMARY KEY, data TEXT);
+                CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT);
+            """)
+
+    def sync(self, new_only=False, page_size=100, max_workers=4):
+        """
+        Brings the mirror up to date
+        :param new_only: True to only look for requests created since the last sync - quicker, as the queue list is
+        only read back to the newest request already mirrored, but changes to older requests are missed
+        :param page_size: queue list calls fetched per page
+        :param max_workers: requests whose details are downloaded at once
+        :return: {'new': n, 'changed': n, 'left_queue': n, 'refreshed': n, 'failed': n}
+        """
+        with _sqlite_connect(self.path) as db:
+            known = dict(db.execute('SELECT workorderid, summary FROM requests WHERE active = 1'))
+            state = dict(db.execute('SELECT key, value FROM sync_state'))
+        watermark = int(state.get('createdtime', 0))
+        syncs = int(state.get('syncs', 0))
+        refresh = not new_only and bool(self.full_refresh_every and syncs and syncs % self.full_refresh_every == 0)
+        now = time.time()
+        counts = {'new': 0, 'changed': 0, 'left_queue': 0, 'refreshed': 0, 'failed': 0}
+        listed = {}
+        to_fetch = []
+        for call in self.api.iter_requests(self.filter_by, page_size, prefetch=True):
+            created = _epoch_ms(call['createdtime'])
+            if new_only and created <= watermark:
+                break
+            request_id = int(call['workorderid'])
+            summary = _json(call)
+            listed[request_id] = (created, call, summary)
+            if request_id not in known:
+                counts['new'] += 1
+                to_fetch.append(request_id)
+            elif known[request_id] != summary:
+                counts['changed'] += 1
+                to_fetch.append(request_id)
+            elif refresh:
+                counts['refreshed'] += 1
+                to_fetch.append(request_id)
+        if not new_only:
+            for request_id in known.keys() - listed.keys():
+                counts['left_queue'] += 1
+                to_fetch.append(request_id)
+        with _sqlite_connect(self.path) as db:
+            # Each write is committed on its own, so the mirror can be read and written while details download.
+            # Summary is only stored with the details, so a failed download is retried next sync
+            with db:
+                db.executemany('UPDATE requests SET last_seen = ? WHERE workorderid = ?',
+                               [(now, request_id) for request_id in listed])
+            for result in self.api.bulk(self._fetch, to_fetch, max_workers=max_workers):
+                if result.error:
+                    counts['failed'] += 1
+                    continue
+                with db:
+                    self._store(db, result.args, listed.get(result.args), *result.result, now=now)
+            newest = max([watermark] + [created for created, _, _ in listed.values()])
+            db.executemany('INSERT OR REPLACE INTO sync_state VALUES (?, ?)',
+                           [('createdtime', str(newest)), ('synced', str(now)),
+                            ('syncs', str(syncs if new_only else syncs + 1))])
+        return counts
+
+    def _fetch(self, request_id):
+        request_id = str(request_id)
+        details = self.api.request_view(request_id)
+        conversations = self.api.request_get_all_conversations(request_id)
+        return details, conversations, _notes_details(self.api, request_id)
+
+    def _store(self, db, request_id, listed, details, conversations, notes, now):
+        if listed:
+            created, call, summary = listed
+            active = 1
+        else:  # left the queue - keep its last queue values
+            row = db.execute('SELECT createdtime, summary FROM requests WHERE workorderid = ?',
+                             (request_id,)).fetchone()
+            created, summary = row
+            call = json.loads(summary)
+            active = 0
+        db.execute('INSERT OR REPLACE INTO requests VALUES (?, ?, ?, ?, ?, ?, ?, '
+                   'COALESCE((SELECT last_seen FROM requests WHERE workorderid = ?), ?), ?, ?, ?)',
+                   (request_id, created, details.get('status', call.get('status')),
+                    details.get('technician', call.get('TECHNICIAN')), details.get('requester', call.get('requester')),
+                    details.get('subject', call.get('subject')), active, request_id, now, now, summary,
+                    _json(details)))
+        newest = db.execute('SELECT MAX(createddate) FROM conversations WHERE workorderid = ?',
+                            (request_id,)).fetchone()[0] or 0
+        db.executemany('INSERT INTO conversations VALUES (?, ?, ?)',
+                       [(request_id, _epoch_ms(conversation['createddate']), _json(conversation))
+                        for conversation in conversations if _epoch_ms(conversation['createddate']) > newest])
+        db.execute('INSERT OR REPLACE INTO notes VALUES (?, ?)', (request_id, _json(notes)))
+
+    def query(self, sql, parameters=()):
+        """
+        Runs sql against the mirror
+        :param sql: e.g. 'SELECT * FROM requests WHERE status = ? AND technician = ?'
+        :param parameters: values for ? placeholders e.g. ('Open', 'Simon Crouch')
+        :return: list of dicts for each row
+        """
+        with _sqlite_connect(self.path) as db:
+            db.row_factory = sqlite3.Row
+            return [dict(row) for row in db.execute(sql, parameters)]
+
+
+class RequestWatcher:
+    """
+    Watches a queue for changes, emitting WatchEvent(type, request_id, request, conversation) to subscribers:
+    'created' - a request newer than any seen before; 'updated' - a request whose queue list values have changed;
+    'conversation' - a conversation newer than any seen on that request. e.g.
+    watcher = RequestWatcher(api)
+    watcher.subscribe(print, types=['created'])
+    watcher.start()
+    Each poll reads GET_REQUESTS pages (most recent first) only until it reaches requests already seen, instead of the
+    whole queue, and fetches conversations only for requests created or updated since the last poll. Every
+    full_scan_every polls the whole queue is read and all its requests' conversations are checked, to catch changes
+    to older requests (a reply doesn't always change the queue list values) and to forget requests that left it.
+    The first poll records where the queue is without emitting events: conversations older than start up are ignored.
+    """
+    types = ('created', 'updated', 'conversation')
+
+    def __init__(self, api, filter_by='All_Requests', interval=60, page_size=100, full_scan_every=10, max_workers=4,
+                 conversations=True):
+        """
+        :param api: API instance
+        :param filter_by: Queue name (not value) to watch
+        :param interval: seconds between polls when started with start()
+        :param page_size: queue list calls fetched per page
+        :param full_scan_every: read the whole queue every this many polls (0 for never, after the first)
+        :param max_workers: requests whose conversations are fetched at once
+        :param conversations: False to not watch conversations
+        """
+        self.api = api
+        self.filter_by = filter_by
+        self.interval = interval
+        self.page_size = page_size
+        self.full_scan_every = full_scan_every
+        self.max_workers = max_workers
+        self.conversations = conversations
+        self.last_error = None  # exception from the last failed poll when started with start()
+        self.last_callback_error = None  # (WatchEvent, exception) from the last subscriber that raised
+        self._subscribers = []  # (types, callback)
+        self._requests = {}  # workorderid: queue list values as json
+        self._conversation_marks = {}  # workorderid: newest conversation createddate seen (epoch ms)
+        self._newest_id = None  # high-water mark: newest workorderid seen
+        self._started_ms = None
+        self._polls = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, callback, types=None):
+        """
+        :param callback: function called with each WatchEvent, from the polling thread - exceptions it raises are
+        kept in last_callback_error, and don't stop other subscribers or the poll
+        :param types: event types to receive e.g. ['created', 'conversation'] (default: all)
+        """
+        unknown = set(types or ()) - set(self.types)
+        if unknown:
+            raise ValueError('Unknown event types: {}'.format(', '.join(sorted(unknown))))
+        self._subscribers.append((frozenset(types or self.types), callback))
+
+    def subscribe_queue(self, queue, types=None, loop=None):
+        """
+        Puts events on an asyncio.Queue e.g. inside a coroutine:
+        queue = asyncio.Queue(); watcher.subscribe_queue(queue); watcher.start(); event = await queue.get()
+        :param queue: asyncio.Queue
+        :param types: event types to receive (default: all)
+        :param loop: event loop the queue is used from (default: the running loop)
+        """
+        loop = asyncio.get_running_loop() if loop is None else loop
+        self.subscribe(lambda event: loop.call_soon_threadsafe(queue.put_nowait, event), types)
+
+    def _emit(self, events):
+        for event in events:
+            for types, callback in self._subscribers:
+                if event.type in types:
+                    try:
+                        callback(event)
+                    except Exception as error:  # a failing subscriber mustn't lose events for the others
+                        self.last_callback_error = (event, error)
+
+    def poll(self):
+        """
+        Checks the queue once and emits what has changed since the last poll
+        :return: list of WatchEvents emitted
+        """
+        with self._lock:  # one poll at a time
+            first = self._newest_id is None
+            full_scan = first or bool(self.full_scan_every and self._polls % self.full_scan_every == 0)
+            self._polls += 1
+            if first:
+                self._started_ms = int(time.time() * 1000)
+            calls = list(self._read_queue(full_scan))  # before changing any state, so a failed poll is retried whole
+            events = []
+            listed = set()
+            to_check = []
+            for call in calls:
+                request_id = int(call['workorderid'])
+                listed.add(request_id)
+                summary = _json(call)
+                previous = self._requests.get(request_id)
+                self._requests[request_id] = summary
+                if first:
+                    continue
+                if previous is None and request_id > self._newest_id:
+                    events.append(WatchEvent('created', str(request_id), call, None))
+                    self._conversation_marks.setdefault(request_id, 0)  # all its conversations are new
+                    to_check.append(request_id)
+                elif previous != summary:
+                    events.append(WatchEvent('updated', str(request_id), call, None))
+                    to_check.append(request_id)
+            if listed:
+                self._newest_id = max([self._newest_id or 0] + list(listed))
+            elif first:
+                self._newest_id = 0
+            if full_scan:
+                for request_id in self._requests.keys() - listed:  # left the queue
+                    del self._requests[request_id]
+                    self._conversation_marks.pop(request_id, None)
+                if not first:
+                    to_check = list(self._requests)
+            if self.conversations and to_check:
+                events.extend(self._new_conversations(to_check))
+        self._emit(events)
+        return events
+
+    def _read_queue(self, full_scan):
+        """
+        Queue list pages, most recent first - all of them, or until a page reaches a request already seen
+        """
+        frm = 0
+        while True:
+            page = self.api.request_get_requests(self.filter_by, str(self.page_size), str(frm))
+            yield from page
+            if len(page) < self.page_size:
+                return
+            if not full_scan and any(int(call['workorderid']) <= self._newest_id for call in page):
+                return
+            frm += self.page_size
+
+    def _new_conversations(self, request_ids):
+        events = []
+        for result in self.api.bulk('request_get_all_conversations', [(str(request_id),) for request_id in request_ids],
+                                    max_workers=self.max_workers):
+            if result.error:  # checked again when the request next changes or on the next full scan
+                continue
+            request_id = int(result.args[0])
+            mark = self._conversation_marks.get(request_id, self._started_ms)
+            newest = mark
+            for conversation in result.result:
+                created = _epoch_ms(conversation['createddate'])
+                if created > mark:
+                    events.append(WatchEvent('conversation', result.args[0], None, conversation))
+                    newest = max(newest, created)
+            self._conversation_marks[request_id] = newest
+        return events
+
+    def start(self):
+        """
+        Polls every interval seconds in a background thread until stop()
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+                self.last_error = None
+            except Exception as error:  # e.g. server unreachable - try again next interval
+                self.last_error = error
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+_export_apis = {}  # (api settings, limits): API, one per export worker process
+
+
+def _export_api(settings):
+    """
+    :param settings: RequestExporter._settings()
+    :return: this process's API for an export, created with the exporting API's limits on first use
+    """
+    key = (settings['api'], settings['limits'])
+    api = _export_apis.get(key)
+    if api is None:
+        rate_limit, operation_rate_limits, concurrency, retry = settings['limits']
+        api = _export_apis[key] = API(
+            *settings['api'], max_in_flight=settings['max_workers'],
+            rate_limit=None if rate_limit is None else RateLimiter(*rate_limit),
+            operation_rate_limits={operation: RateLimiter(*limit) for operation, limit in operation_rate_limits},
+            concurrency=None if concurrency is None else AdaptiveConcurrency(*concurrency),
+            retry=RetryPolicy(*retry))
+    return api
+
+
+def _export_range(settings, frm, offset):
+    """
+    Exports one GET_REQUESTS range, in an export worker process - see RequestExporter
+    :param settings: RequestExporter._settings()
+    :param frm: range start, as positions were when the export started
+    :param offset: requests logged since the export started, added to frm
+    :return: (frm, requests in the range, their conversations) - not counting the overlap
+    """
+    api = _export_api(settings)
+    # Also read up to overlap requests before the range, which have moved into it if requests before it have closed
+    start = max(0, frm + offset - settings['overlap'])
+    fields = {'from': str(start), 'limit': str(frm + offset - start + settings['range_size']),
+              'filterby': settings['filter_by']}
+    calls = api.send_records('request/', 'GET_REQUESTS', fields)  # dicts of raw values, times as epoch strings
+    in_range = max(0, len(calls) - (frm + offset - start))
+    if not in_range:
+        return frm, 0, 0
+    tables = {'requests': calls}
+    if settings['conversations']:
+        tables['conversations'] = []
+        for result in api.bulk(functools.partial(RequestExporter._conversations, api),
+                               [call['workorderid'] for call in calls], max_workers=settings['max_workers']):
+            if result.error:
+                raise result.error  # the range is exported again on resume
+            tables['conversations'].extend(result.result)
+    if settings['notes']:
+        tables['notes'] = []
+        for result in api.bulk(functools.partial(RequestExporter._notes, api),
+                               [call['workorderid'] for call in calls], max_workers=settings['max_workers']):
+            if result.error:
+                raise result.error
+            tables['notes'].append(result.result)
+    for table, rows in tables.items():
+        path = os.path.join(settings['directory'], '{}-{:09d}.{}'.format(table, frm, settings['format']))
+        RequestExporter._write(path + '.tmp', rows, settings['format'])
+        os.replace(path + '.tmp', path)  # only complete shards have their final name
+    in_range_ids = {call['workorderid'] for call in calls[-in_range:]}
+    return frm, in_range, sum(row['workorderid'] in in_range_ids for row in tables.get('conversations', ()))
+
+
+class RequestExporter:
+    """
+    Exports a whole queue - requests, and optionally their conversations and notes - to sharded files, splitting the
+    GET_REQUESTS from/limit ranges across a pool of processes (each fetching conversations with a pool of threads).
+    Each range is written to its own shard e.g. requests-000002000.jsonl, conversations-000002000.jsonl, with values
+    as the server returns them (times as epoch millisecond strings) plus workorderid on conversation and note rows.
+    Finished ranges are checkpointed to export.json in the directory, so running again resumes a failed export.
+    The queue is read by position, which changes as requests are logged and closed: a request logged moves the
+    requests after it down one, so one can be exported twice; a request closed moves them up one, so one could be
+    missed. Each range therefore also exports the overlap requests before it, so up to overlap requests can close
+    during an export (or before a resume) without losing any. Shards overlap as a result - dedupe on workorderid.
+    Requests logged since the export started are counted and skipped over on resume.
+    The process pool needs the usual if __name__ == '__main__': guard in scripts run on Windows.
+    """
+    formats = ('jsonl', 'parquet')
+
+    def __init__(self, api, directory, filter_by='All_Requests', file_format='jsonl', range_size=1000, processes=4,
+                 max_workers=4, conversations=True, notes=False, overlap=100):
+        """
+        :param api: API instance - the worker processes use its key, url, timeout and retry policy (without
+        on_retry), and its rate limits and concurrency split evenly between them
+        :param directory: folder for the shards and checkpoint, created if needed
+        :param filter_by: Queue name (not value) to export
+        :param file_format: 'jsonl' or 'parquet' (needs the pyarrow module)
+        :param range_size: requests per GET_REQUESTS range (and shard)
+        :param processes: worker processes
+        :param max_workers: conversation/note downloads at once in each process
+        :param conversations: False to not export conversations
+        :param notes: True to also export notes (a GET_NOTES call per request)
+        :param overlap: requests before each range also exported with it - more requests than this closing during
+        the export can lose requests
+        """
+        if file_format not in self.formats:
+            raise ValueError('file_format must be one of: {}'.format(', '.join(self.formats)))
+        if file_format == 'parquet':
+            self._pyarrow()
+        self.api = api
+        self.directory = directory
+        self.filter_by = filter_by
+        self.file_format = file_format
+        self.range_size = range_size
+        self.processes = processes
+        self.max_workers = max_workers
+        self.conversations = conversations
+        self.notes = notes
+        self.overlap = overlap
+        self.checkpoint_path = os.path.join(directory, 'export.json')
+
+    @staticmethod
+    def _pyarrow():
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('Parquet export requires the pyarrow module') from None
+        return pyarrow
+
+    def _settings(self):
+        return {'api': (self.api.api_key, self.api.api_url_base, self.api.timeout), 'limits': self._limits(),
+                'directory': self.directory, 'filter_by': self.filter_by, 'format': self.file_format,
+                'range_size': self.range_size, 'overlap': self.overlap, 'max_workers': self.max_workers,
+                'conversations': self.conversations, 'notes': self.notes}
+
+    def _limits(self):
+        """
+        :return: the API's limits as picklable values for _export_api - (rate_limit, operation_rate_limits,
+        concurrency, retry), with rates and concurrency divided between the processes
+        """
+        def share(limiter):
+            return limiter.rate / self.processes, max(1, limiter.burst // self.processes)
+        api = self.api
+        rate_limit = None if api.rate_limit is None else share(api.rate_limit)
+        operation_rate_limits = tuple(sorted((operation, share(limiter))
+                                             for operation, limiter in api.operation_rate_limits.items()))
+        concurrency = None
+        if api.concurrency is not None:
+            minimum = max(1, api.concurrency.minimum // self.processes)
+            concurrency = (max(minimum, api.concurrency.limit // self.processes), minimum,
+                           max(minimum, api.concurrency.maximum // self.processes), api.concurrency.latency_target)
+        retry = (api.retry.max_attempts, api.retry.backoff, api.retry.max_backoff, api.retry.deadline,
+                 tuple(sorted(api.retry.retry_operations)))
+        return rate_limit, operation_rate_limits, concurrency, retry
+
+    @staticmethod
+    def _conversations(api, request_id):
+        conversations = api.send_records('request/' + request_id + '/allconversation/', 'GET_ALL_CONVERSATIONS')
+        for conversation in conversations:
+            conversation['workorderid'] = request_id
+        return conversations
+
+    @staticmethod
+    def _notes(api, request_id):
+        return {'workorderid': request_id, 'notes': _json(_notes_details(api, request_id))}
+
+    @staticmethod
+    def _write(path, rows, file_format):
+        if file_format == 'jsonl':
+            with open(path, 'w', encoding='utf-8') as file:
+                for row in rows:
+                    file.write(json.dumps(row))
+                    file.write('\n')
+            return
+        pyarrow = RequestExporter._pyarrow()
+        names = list(dict.fromkeys(name for row in rows for name in row))  # rows can differ in fields
+        schema = pyarrow.schema([(name, pyarrow.string()) for name in names])
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows, schema=schema), path)
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as file:
+                checkpoint = json.load(file)
+        except FileNotFoundError:
+            return None
+        if (checkpoint['filter_by'], checkpoint['format'], checkpoint['range_size']) != (
+                self.filter_by, self.file_format, self.range_size):
+            raise ValueError('{} is from an export with different settings'.format(self.checkpoint_path))
+        return checkpoint
+
+    def _save_checkpoint(self, checkpoint):
+        with open(self.checkpoint_path + '.tmp', 'w') as file:
+            json.dump(checkpoint, file)
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+    def _logged_since(self, newest_id):
+        """
+        :return: number of requests in the queue newer than newest_id
+        """
+        count = 0
+        for call in self.api.iter_requests(self.filter_by, self.range_size):
+            if int(call['workorderid']) <= newest_id:
+                break
+            count += 1
+        return count
+
+    def run(self):
+        """
+        Exports the queue, or the ranges not yet finished if there's a checkpoint. If a range fails, the ranges
+        already running finish and are checkpointed, then the error is raised - run again to resume.
+        :return: {'ranges': exported this run, 'skipped': finished on an earlier run, 'requests': n, 'conversations': n}
+        - requests and conversations don't count the overlap
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        checkpoint = self._load_checkpoint()
+        if checkpoint is None:
+            newest = self.api.request_get_requests(self.filter_by, '1', '0')
+            checkpoint = {'filter_by': self.filter_by, 'format': self.file_format, 'range_size': self.range_size,
+                          'newest_id': int(newest[0]['workorderid']) if newest else 0, 'done': [], 'end': None}
+            self._save_checkpoint(checkpoint)
+            offset = 0
+        else:
+            offset = self._logged_since(checkpoint['newest_id'])
+        done = set(checkpoint['done'])
+        counts = {'ranges': 0, 'skipped': len(done), 'requests': 0, 'conversations': 0}
+        settings = self._settings()
+        starts = (frm for frm in itertools.count(0, self.range_size) if frm not in done)
+        error = None
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.processes) as pool:
+            pending = set()
+            while True:
+                while error is None and len(pending) < self.processes:
+                    frm = next(starts)
+                    if checkpoint['end'] is not None and frm >= checkpoint['end']:
+                        break
+                    pending.add(pool.submit(_export_range, settings, frm, offset))
+                if not pending:
+                    break
+                finished, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                        continue
+                    frm, requests_count, conversations_count = future.result()
+                    if requests_count < self.range_size:  # last range
+                        end = frm + requests_count
+                        checkpoint['end'] = end if checkpoint['end'] is None else min(checkpoint['end'], end)
+                    checkpoint['done'].append(frm)
+                    counts['ranges'] += 1
+                    counts['requests'] += requests_count
+                    counts['conversations'] += conversations_count
+                self._save_checkpoint(checkpoint)
+        if error is not None:
+            raise error
+        return counts
+
+
+class _PendingWrite:
+    """
+    One queued write - see WriteQueue
+    """
+    __slots__ = ('id', 'request_id', 'operation', 'args', 'started')
+
+    def __init__(self, write_id, request_id, operation, args):
+        self.id = write_id
+        self.request_id = request_id
+        self.operation = operation
+        self.args = args  # positional args after request_id
+        self.started = False
+
+    def __repr__(self):
+        return '_PendingWrite({!r}, {!r}, {!r})'.format(self.request_id, self.operation, self.args)
+
+
+class WriteQueue:
+    """
+    Write-behind queue for note_add, request_edit and request_assign: calls return as soon as the write is queued
+    (and saved, if there's a path), and background threads send them. e.g.
+    writes = WriteQueue(api, 'sdplus_writes.db')
+    writes.request_edit('184699', {'status': 'Hold - Awaiting Third Party'})
+    writes.note_add('184699', 'False', 'Chased supplier')
+    Writes to one request are sent one at a time, in the order queued; different requests are sent concurrently.
+    A request_edit queued straight after another unsent request_edit to the same request is merged into it (later
+    fields win), and likewise a request_assign replaces an unsent request_assign.
+    Each attempt is one send(), which itself retries as api.retry allows: other transient errors (timeouts, 5xx, html
+    error pages) only for operations in its retry_operations (e.g. ['EDIT_REQUEST']), as the write may have been
+    made - retrying ADD_NOTE could add the note twice. The queue adds retries only for writes that couldn't reach the
+    server at all (RetryPolicy.not_sent), with backoff, holding back later writes to that request, up to max_attempts
+    sends - so at most max_attempts * api.retry.max_attempts connection attempts. Other failures, and writes out of
+    attempts, are passed to on_result with their error. Unsent writes are loaded again when the queue is next created.
+    """
+    operations = {'note_add': 'ADD_NOTE', 'request_edit': 'EDIT_REQUEST', 'request_assign': 'ASSIGN_REQUEST'}
+
+    def __init__(self, api, path=None, max_workers=4, retry_delay=1.0, max_retry_delay=60, max_attempts=10,
+                 on_result=None):
+        """
+        :param api: API instance
+        :param path: sqlite file path to keep unsent writes in e.g. 'sdplus_writes.db' (None: memory only)
+        :param max_workers: writes sent at once
+        :param retry_delay: seconds before the first retry of a failed write, doubling each time
+        :param max_retry_delay: longest wait between retries
+        :param max_attempts: sends per write that couldn't reach the server, including the first
+        :param on_result: function called with (write, result, error) as each write is sent or given up on - write
+        has request_id, operation and args attributes, error is the exception for a write that failed. Exceptions it
+        raises are kept in last_callback_error
+        """
+        self.api = api
+        self.path = path
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.on_result = on_result
+        self.last_callback_error = None  # (write, exception) from the last on_result call that raised
+        self._pending = collections.OrderedDict()  # request_id: deque of _PendingWrites, oldest first
+        self._failures = {}  # request_id: (failures in a row, monotonic time to retry at)
+        self._in_flight = 0
+        self._next_id = 1
+        self._closed = False
+        self._condition = threading.Condition()
+        self._db = None
+        if self.path:
+            # Kept open (used under self._condition) - opening a connection per write costs more than the write
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')  # with WAL, still safe if the process dies
+            with self._db:
+                self._db.execute('CREATE TABLE IF NOT EXISTS writes '
+                                 '(id INTEGER PRIMARY KEY, request_id TEXT, operation TEXT, args TEXT)')
+            for write_id, request_id, operation, args in self._db.execute('SELECT * FROM writes ORDER BY id'):
+                self._pending.setdefault(request_id, collections.deque()).append(
+                    _PendingWrite(write_id, request_id, operation, json.loads(args)))
+                self._next_id = write_id + 1
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(max_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def __len__(self):
+        """
+        :return: writes not yet sent (including those being sent)
+        """
+        with self._condition:
+            return sum(len(writes) for writes in self._pending.values())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def note_add(self, request_id, is_public='False', text=''):
+        self._put(request_id, 'note_add', [is_public, text])
+
+    def request_edit(self, request_id, fields):
+        self._put(request_id, 'request_edit', [dict(fields)])
+
+    def request_assign(self, request_id, technician_id):
+        self._put(request_id, 'request_assign', [technician_id])
+
+    def _put(self, request_id, operation, args):
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('WriteQueue is closed')
+            writes = self._pending.setdefault(request_id, collections.deque())
+            last = writes[-1] if writes else None
+            if last is not None and not last.started and last.operation == operation != 'note_add':
+                if operation == 'request_edit':
+                    last.args[0].update(args[0])
+                else:
+                    last.args = args
+                self._save('UPDATE writes SET args = ? WHERE id = ?', (json.dumps(last.args), last.id))
+            else:
+                write = _PendingWrite(self._next_id, request_id, operation, args)
+                self._next_id += 1
+                self._save('INSERT INTO writes VALUES (?, ?, ?, ?)',
+                           (write.id, request_id, operation, json.dumps(args)))
+                writes.append(write)
+                self._condition.notify()
+
+    def _save(self, sql, parameters):
+        if self._db is not None:
+            with self._db:
+                self._db.execute(sql, parameters)
+
+    def _next_write(self):
+        """
+        :return: (the oldest unstarted write for a request with nothing in flight, seconds until one is ready)
+        """
+        now = time.monotonic()
+        wait = None
+        for request_id, writes in self._pending.items():
+            if writes[0].started:
+                continue
+            retry_at = self._failures.get(request_id, (0, 0))[1]
+            if retry_at > now:
+                wait = retry_at - now if wait is None else min(wait, retry_at - now)
+                continue
+            self._pending.move_to_end(request_id)  # take turns between requests
+            return writes[0], None
+        return None, wait
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        return
+                    write, wait = self._next_write()
+                    if write is not None:
+                        break
+                    self._condition.wait(wait)
+                write.started = True
+                self._in_flight += 1
+            result = error = None
+            try:
+                result = getattr(self.api, write.operation)(write.request_id, *write.args)
+            except Exception as exception:
+                error = exception
+            with self._condition:
+                self._in_flight -= 1
+                write.started = False
+                failures = self._failures.get(write.request_id, (0, 0))[0] + 1
+                retry = error is not None and failures < self.max_attempts and RetryPolicy.not_sent(error)
+                if retry:
+                    delay = min(self.max_retry_delay, self.retry_delay * 2 ** (failures - 1))
+                    self._failures[write.request_id] = (failures, time.monotonic() + delay)
+                else:
+                    self._failures.pop(write.request_id, None)
+                    writes = self._pending[write.request_id]
+                    writes.popleft()
+                    if not writes:
+                        del self._pending[write.request_id]
+                    self._save('DELETE FROM writes WHERE id = ?', (write.id,))
+                self._condition.notify_all()
+            if not retry and self.on_result is not None:
+                try:
+                    self.on_result(write, result, error)
+                except Exception as callback_error:  # a failing callback mustn't stop the queue
+                    self.last_callback_error = (write, callback_error)
+
+    def flush(self, timeout=None):
+        """
+        Waits for all queued writes to be sent
+        :param timeout: seconds to wait at most (None: until done)
+        :return: True if everything was sent, False on timeout
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending, timeout)
+
+    def close(self, flush=True, timeout=None):
+        """
+        Stops the background threads - writes not sent stay saved (with a path) for the next WriteQueue
+        :param flush: True to wait for queued writes to be sent first
+        :param timeout: seconds to wait for them at most
+        :return: True if everything was sent
+        """
+        sent = self.flush(timeout) if flush else not self._pending
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        return sent
+
+
+class RequestStore:
+    """
+    In-memory store of requests (dicts from request_get_requests/iter_requests) indexed for quick filtering e.g.
+    store = RequestStore(api.iter_requests())
+    store.query(status='Open', technician='Simon Crouch', created_after=datetime.datetime.now() - datetime.timedelta(1))
+    Requests are indexed on status, technician, requester, group and overdue, and sorted by createdtime.
+    Adding a request with an existing workorderid replaces it, so pages can be added as they are fetched.
+    Thread safe.
+    """
+    # query name: record keys it is read from (GET_REQUESTS and GET_REQUEST differ in case)
+    _indexed_fields = {'status': ('status',), 'technician': ('TECHNICIAN', 'technician'), 'requester': ('requester',),
+                       'group': ('group', 'GROUP'), 'overdue': ('isoverdue',)}
+
+    def __init__(self, requests_list=()):
+        """
+        :param requests_list: iterable of request dicts to add
+        """
+        self._requests = {}  # workorderid: request
+        self._indexes = {field: collections.defaultdict(set) for field in self._indexed_fields}
+        self._created = []  # sorted [(createdtime, workorderid), ...]
+        self._lock = threading.Lock()
+        self.add(requests_list)
+
+    def __len__(self):
+        return len(self._requests)
+
+    def __contains__(self, request_id):
+        return request_id in self._requests
+
+    def get(self, request_id):
+        return self._requests.get(request_id)
+
+    @classmethod
+    def _field(cls, request, field):
+        for key in cls._indexed_fields[field]:
+            if key in request:
+                value = request[key]
+                return value == 'true' if field == 'overdue' else value
+        return None
+
+    @staticmethod
+    def _created_time(request):
+        created = request.get('createdtime')
+        if created is None or isinstance(created, datetime.datetime):
+            return created
+        return API.epoch_to_datetime(created)
+
+    def add(self, requests_list):
+        """
+        Adds (or replaces, by workorderid) requests
+        :param requests_list: iterable of request dicts
+        """
+        with self._lock:
+            for request in requests_list:
+                request_id = request['workorderid']
+                if request_id in self._requests:
+                    self._unindex(request_id)
+                self._requests[request_id] = request
+                for field, index in self._indexes.items():
+                    index[self._field(request, field)].add(request_id)
+                created = self._created_time(request)
+                if created is not None:
+                    bisect.insort(self._created, (created, request_id))
+
+    def remove(self, request_id):
+        with self._lock:
+            if request_id in self._requests:
+                self._unindex(request_id)
+                del self._requests[request_id]
+
+    def _unindex(self, request_id):
+        request = self._requests[request_id]
+        for field, index in self._indexes.items():
+            value = self._field(request, field)
+            index[value].discard(request_id)
+            if not index[value]:
+                del index[value]
+        created = self._created_time(request)
+        if created is not None:
+            del self._created[bisect.bisect_left(self._created, (created, request_id))]
+
+    def query(self, created_after=None, created_before=None, **fields):
+        """
+        Requests matching all of the given values, most recent first
+        :param created_after: datetime - only requests created at or after this
+        :param created_before: datetime - only requests created before this
+        :param fields: any of status, technician, requester, group (values as in the request) and overdue (True/False)
+        e.g. query(status='Open', technician='Simon Crouch')
+        :return: list of request dicts
+        """
+        unknown = fields.keys() - self._indexes.keys()
+        if unknown:
+            raise ValueError('Cannot query on: ' + ', '.join(sorted(unknown)))
+        with self._lock:
+            matches = sorted((self._indexes[field].get(value, set()) for field, value in fields.items()), key=len)
+            if created_after is not None or created_before is not None:
+                start = 0 if created_after is None else bisect.bisect_left(self._created, (created_after,))
+                end = len(self._created) if created_before is None else \
+                    bisect.bisect_left(self._created, (created_before,))
+                request_ids = [request_id for _, request_id in reversed(self._created[start:end])
+                               if all(request_id in match for match in matches)]
+            else:
+                if matches:
+                    request_ids = set(matches[0]).intersection(*matches[1:])
+                else:
+                    request_ids = set(self._requests)
+                request_ids = sorted(request_ids, key=lambda request_id: self._sort_key(self._requests[request_id]),
+                                     reverse=True)
+            return [self._requests[request_id] for request_id in request_ids]
+
+    def _sort_key(self, request):
+        created = self._created_time(request)
+        return (created is not None, created or datetime.datetime.min, request['workorderid'])
+
+
+def main(argv=None):
+    """
+    Command line for common operations, printing results as json e.g.
+    python -m sdplus_api_rest view 184699
+    python -m sdplus_api_rest note 184699 "Chased supplier" --public
+    python -m sdplus_api_rest close 184699 --comment "Fixed" --accepted
+    python -m sdplus_api_rest list --queue Open_System --limit 50
+    python -m sdplus_api_rest export exports/ --format jsonl --processes 8
+    The technician key and api url are read from --key/--url, or the SDPLUS_API_KEY/SDPLUS_URL environment variables.
+    :return: exit code - 1 if the server reported a failure
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m sdplus_api_rest', description='Service Desk Plus REST API')
+    parser.add_argument('--key', default=os.environ.get('SDPLUS_API_KEY'),
+                        help='technician key (default: $SDPLUS_API_KEY)')
+    parser.add_argument('--url', default=os.environ.get('SDPLUS_URL', 'http://sdplus/sdpapi/'),
+                        help='api url (default: $SDPLUS_URL or http://sdplus/sdpapi/)')
+    parser.add_argument('--indent', type=int, default=None, help='indent the json output')
+    commands = parser.add_subparsers(dest='command', required=True)
+    view = commands.add_parser('view', help='view a request')
+    view.add_argument('request_id')
+    note = commands.add_parser('note', help='add a note to a request')
+    note.add_argument('request_id')
+    note.add_argument('text')
+    note.add_argument('--public', action='store_true', help='show the note to the requester')
+    close = commands.add_parser('close', help='close a request')
+    close.add_argument('request_id')
+    close.add_argument('--comment', default='', help='closure comment')
+    close.add_argument('--accepted', action='store_true', help='closure accepted')
+    listing = commands.add_parser('list', help='list the requests in a queue, most recent first')
+    listing.add_argument('--queue', default='All_Requests', help='queue name (not value) e.g. Open_System')
+    listing.add_argument('--limit', type=int, default=100, help='max requests to list (0 for all)')
+    export = commands.add_parser('export', help='export a queue to files - see RequestExporter')
+    export.add_argument('directory')
+    export.add_argument('--queue', default='All_Requests', help='queue name (not value) e.g. Open_System')
+    export.add_argument('--format', default='jsonl', choices=RequestExporter.formats)
+    export.add_argument('--range-size', type=int, default=1000, help='requests per range (and file)')
+    export.add_argument('--processes', type=int, default=4, help='worker processes')
+    export.add_argument('--notes', action='store_true', help='also export notes')
+    args = parser.parse_args(argv)
+    if not args.key:
+        parser.error('a technician key is needed: --key or the SDPLUS_API_KEY environment variable')
+    with API(args.key, args.url) as api:
+        if args.command == 'view':
+            result = api.request_view(args.request_id)
+        elif args.command == 'note':
+            result = api.note_add(args.request_id, 'True' if args.public else 'False', args.text)
+        elif args.command == 'close':
+            result = api.request_close(args.request_id, args.accepted, args.comment)
+        elif args.command == 'list':
+            calls = api.iter_requests(args.queue, min(args.limit, 1000) or 1000)
+            result = list(itertools.islice(calls, args.limit or None))
+        else:
+            result = RequestExporter(api, args.directory, args.queue, args.format, args.range_size, args.processes,
+                                     notes=args.notes).run()
+    print(json.dumps(result, indent=args.indent, default=lambda item: dict(item)
+                     if isinstance(item, collections.abc.Mapping) else str(item)))
+    return 1 if isinstance(result, dict) and result.get('response_status') == 'Failed' else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
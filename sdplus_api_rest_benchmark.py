@@ -0,0 +1,172 @@
+"""
+Benchmarks for sdplus_api_rest against the local MockServer - throughput, p50/p99 latency and peak memory.
+python sdplus_api_rest_benchmark.py                          # print results
+python sdplus_api_rest_benchmark.py --json baseline.json     # save results
+python sdplus_api_rest_benchmark.py --compare baseline.json  # exit 1 if throughput/memory regressed vs baseline
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+import xmltodict
+from sdplus_api_rest import API, _xml_element
+from sdplus_api_rest_mock import MockServer
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def measure(name, function, repeat, items=1, memory=True):
+    """
+    Runs function repeat times, then once more to measure memory
+    :param name: benchmark name
+    :param function: function to run, without arguments
+    :param repeat: times to run function
+    :param items: items handled per run (e.g. calls in a bulk run) - throughput is items per second
+    :param memory: False to not measure memory (e.g. when function runs another process)
+    :return: {'name': ..., 'throughput': items/s, 'p50': s, 'p99': s, 'peak_memory': bytes or None}
+    """
+    function()  # warm up (connections, caches)
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        call_started = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    peak_memory = None
+    if memory:
+        tracemalloc.start()
+        function()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'name': name, 'runs': repeat, 'throughput': repeat * items / elapsed, 'p50': statistics.median(latencies),
+            'p99': percentile(latencies, 99), 'peak_memory': peak_memory}
+
+
+def create_xml_benchmarks(repeat, calls=1000):
+    """
+    Request xml building - cached templates (API._create_xml) against building and serialising an ElementTree per call
+    :return: list of measure() results
+    """
+    fields = [{'subject': 'Printer {} & scanner <offline>'.format(number), 'requester': 'Requester {}'.format(number),
+               'description': 'Generated description ' * 10, 'group': 'Service Desk', 'priority': '2 High'}
+              for number in range(calls)]
+    note = {'isPublic': 'false', 'notesText': 'Called user, awaiting reply'}
+    return [
+        measure('create_xml request_add fields ({} calls)'.format(calls),
+                lambda: [API._create_xml(row) for row in fields], repeat, calls),
+        measure('create_xml request_add fields, ElementTree ({} calls)'.format(calls),
+                lambda: [ET.tostring(_xml_element(row, ())) for row in fields], repeat, calls),
+        measure('create_xml note_add ({} calls)'.format(calls),
+                lambda: [API._create_xml(note, ['Notes', 'Note']) for _ in range(calls)], repeat, calls),
+        measure('create_xml note_add, ElementTree ({} calls)'.format(calls),
+                lambda: [ET.tostring(_xml_element(note, ('Notes', 'Note'))) for _ in range(calls)], repeat, calls),
+    ]
+
+
+def import_benchmarks(repeat):
+    """
+    Python start up plus import, in a new process each run - sdplus_api_rest alone (its dependencies are imported on
+    first use), and with the dependencies an eager import used to load
+    :return: list of measure() results
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+
+    def run(code):
+        return lambda: subprocess.run([sys.executable, '-c', code], cwd=folder, check=True)
+    return [
+        measure('python start up', run('pass'), repeat, memory=False),
+        measure('import sdplus_api_rest', run('import sdplus_api_rest'), repeat, memory=False),
+        measure('import sdplus_api_rest, requests, xmltodict, aiohttp',
+                run('import sdplus_api_rest, requests, xmltodict, aiohttp'), repeat, memory=False),
+    ]
+
+
+def benchmarks(server, repeat, records, bulk_items):
+    """
+    :return: list of measure() results
+    """
+    api = API('benchmark', server.url)
+    request_id = server.requests[0]['workorderid']
+    _, requests_xml = server.respond('/sdpapi/request/', {
+        'OPERATION_NAME': 'GET_REQUESTS',
+        'INPUT_DATA': '<name>from</name><value>0</value><name>limit</name><value>{}</value>'.format(records)})
+    bulk_ids = [request['workorderid'] for request in server.requests[:bulk_items]]
+    results = [
+        measure('send GET_REQUEST', lambda: api.send('request/' + request_id, 'GET_REQUEST'), repeat),
+        measure('send EDIT_REQUEST', lambda: api.request_edit(request_id, {'subject': 'Benchmark'}), repeat),
+        measure('parse xmltodict + output_params_to_list ({} records)'.format(records),
+                lambda: API.output_params_to_list(xmltodict.parse(requests_xml)), repeat, records),
+        measure('parse iter_records ({} records)'.format(records),
+                lambda: list(API.iter_records(requests_xml)), repeat, records),
+        measure('request_get_requests ({} records)'.format(records),
+                lambda: api.request_get_requests(limit=str(records)), repeat, records),
+        measure('request_get_all_conversations', lambda: api.request_get_all_conversations(request_id), repeat),
+        measure('bulk request_view ({} calls)'.format(bulk_items),
+                lambda: list(api.bulk('request_view', bulk_ids, max_workers=8)), max(1, repeat // 10), bulk_items),
+    ]
+    api.close()
+    return results + create_xml_benchmarks(repeat)
+
+
+def regressions(results, baseline, tolerance):
+    """
+    :return: list of messages for benchmarks whose throughput dropped, or peak memory rose, by more than tolerance
+    """
+    baseline = {result['name']: result for result in baseline}
+    messages = []
+    for result in results:
+        before = baseline.get(result['name'])
+        if before is None:
+            continue
+        if result['throughput'] < before['throughput'] * (1 - tolerance):
+            messages.append('{}: throughput {:.1f}/s, was {:.1f}/s'.format(
+                result['name'], result['throughput'], before['throughput']))
+        if result['peak_memory'] is None or before['peak_memory'] is None:
+            continue
+        if result['peak_memory'] > before['peak_memory'] * (1 + tolerance):
+            messages.append('{}: peak memory {} bytes, was {} bytes'.format(
+                result['name'], result['peak_memory'], before['peak_memory']))
+    return messages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=50, help='runs per benchmark')
+    parser.add_argument('--records', type=int, default=1000, help='records per GET_REQUESTS response')
+    parser.add_argument('--bulk', type=int, default=200, help='calls per bulk run')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the mock server adds to each response')
+    parser.add_argument('--json', help='save results to this file')
+    parser.add_argument('--compare', help='baseline results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed regression vs baseline e.g. 0.25')
+    args = parser.parse_args(argv)
+    with MockServer(requests=max(args.records, args.bulk), latency=args.latency) as server:
+        results = benchmarks(server, args.repeat, args.records, args.bulk)
+    results += import_benchmarks(max(5, args.repeat // 5))
+    print('{:<55} {:>12} {:>10} {:>10} {:>12}'.format('benchmark', 'items/s', 'p50 ms', 'p99 ms', 'peak KiB'))
+    for result in results:
+        print('{:<55} {:>12.1f} {:>10.2f} {:>10.2f} {:>12}'.format(
+            result['name'], result['throughput'], result['p50'] * 1000, result['p99'] * 1000,
+            '-' if result['peak_memory'] is None else '{:.1f}'.format(result['peak_memory'] / 1024)))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            messages = regressions(results, json.load(file), args.tolerance)
+        for message in messages:
+            print('REGRESSION ' + message)
+        return 1 if messages else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
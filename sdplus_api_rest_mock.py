@@ -0,0 +1,231 @@
+"""
+Local stand-in for the Service Desk Plus REST API, serving generated xml, for tests and benchmarks e.g.
+with MockServer(requests=1000, latency=0.01) as server:
+    api = API('any key', server.url)
+    api.request_get_requests()
+"""
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+STATUSES = ['Open', 'Open', 'Open', 'Hold - Awaiting Third Party', 'Resolved']
+PRIORITIES = ['1 Critical', '2 High', '3 Medium', '4 Low', None]
+GROUPS = ['Back Office Third Party/CSC', 'Service Desk', 'Desktop Support', 'Networks']
+FILTERS = {'All_Requests': 'All Requests', 'Open_System': 'All Open Requests', 'Overdue_System': 'Overdue Requests'}
+
+
+class MockServer:
+    """
+    Threaded http server answering Service Desk Plus API operations from generated data.
+    Requests are numbered from first_request_id, most recent (highest id) first as on a real server.
+    calls counts the operations received e.g. server.calls['GET_REQUESTS']
+    """
+    def __init__(self, requests=1000, conversations=5, technicians=50, latency=0.0, jitter=0.0, seed=0,
+                 host='127.0.0.1', port=0, first_request_id=100000):
+        """
+        :param requests: number of requests in the queue
+        :param conversations: conversations per request
+        :param technicians: number of technicians
+        :param latency: seconds added to every response
+        :param jitter: up to this many seconds (random) added to latency
+        :param seed: random seed for the generated data
+        :param host: address to listen on
+        :param port: port to listen on (0 for any free port)
+        :param first_request_id: workorderid of the oldest request
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.conversations = conversations
+        self.calls = {}
+        self.uploads = []  # (url path, filename, bytes of file) for each attachment received
+        self.added_conversations = {}  # workorderid: conversations added with add_conversation()
+        self._calls_lock = threading.Lock()
+        self._random = random.Random(seed)
+        self.technicians = ['Technician {}'.format(number) for number in range(1, technicians + 1)]
+        self.requests = [self._request(request_id) for request_id in
+                         range(first_request_id + requests - 1, first_request_id - 1, -1)]
+        self._requests_by_id = {request['workorderid']: request for request in self.requests}
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def url(self):
+        """
+        Base url to give API e.g. http://127.0.0.1:12345/sdpapi/
+        """
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/sdpapi/'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_request(self, **fields):
+        """
+        Logs a new (most recent) request, created now
+        :param fields: values to set e.g. subject='Printer offline'
+        :return: the request dict - changes to it are seen by later calls
+        """
+        request = self._request(int(self.requests[0]['workorderid']) + 1 if self.requests else 100000)
+        request['createdtime'] = str(int(time.time() * 1000))
+        request['duebytime'] = str(int(request['createdtime']) + 28800000)
+        request.update(fields)
+        self.requests.insert(0, request)
+        self._requests_by_id[request['workorderid']] = request
+        return request
+
+    def add_conversation(self, request_id, subject='Reply'):
+        """
+        Adds a conversation, created now, to a request
+        """
+        request = self._requests_by_id[str(request_id)]
+        self.added_conversations.setdefault(request['workorderid'], []).append(
+            {'from': request['requester'], 'type': 'Notification', 'subject': subject,
+             'createddate': str(int(time.time() * 1000))})
+
+    def _request(self, request_id):
+        created = 1465832199994 + (request_id % 100000) * 600000
+        return {
+            'workorderid': str(request_id),
+            'subject': 'Generated request {} [{}]'.format(request_id, self._random.choice(GROUPS)),
+            'requester': 'Requester {}'.format(self._random.randint(1, 500)),
+            'createdby': 'Requester {}'.format(self._random.randint(1, 500)),
+            'createdtime': str(created),
+            'duebytime': str(created + 28800000),
+            'isoverdue': self._random.choice(['true', 'false', 'false']),
+            'status': self._random.choice(STATUSES),
+            'PRIORITY': self._random.choice(PRIORITIES),
+            'TECHNICIAN': self._random.choice(self.technicians + [None]),
+            'group': self._random.choice(GROUPS),
+        }
+
+    def _count(self, operation):
+        with self._calls_lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    # xml
+    @staticmethod
+    def _parameters(fields):
+        return ''.join('<parameter><name>{}</name><value>{}</value></parameter>'.format(
+            escape(name), '' if value is None else escape(value)) for name, value in fields.items())
+
+    @staticmethod
+    def _result(status='Success', message='Request processed successfully'):
+        return '<result><statuscode>{}</statuscode><status>{}</status><message>{}</message></result>'.format(
+            200 if status == 'Success' else 4000, status, escape(message))
+
+    def _api(self, operation, details):
+        return ('<?xml version="1.0" encoding="UTF-8"?><API version="1.0" locale="en"><response>'
+                '<operation name="{}">{}<Details>{}</Details></operation></response></API>').format(
+            operation, self._result(), details)
+
+    def _operation(self, operation, details='', status='Success', message='Request processed successfully'):
+        return '<operation name="{}">{}<Details>{}</Details></operation>'.format(
+            operation, self._result(status, message), details)
+
+    def _records(self, operation, rows):
+        return self._api(operation, ''.join('<record>{}</record>'.format(self._parameters(row)) for row in rows))
+
+    def _conversations(self, request):
+        created = int(request['createdtime'])
+        return [{'from': request['requester'], 'type': 'Notification',
+                 'subject': 'Re: ' + request['subject'], 'createddate': str(created + number * 3600000)}
+                for number in range(self.conversations)] + self.added_conversations.get(request['workorderid'], [])
+
+    def respond(self, path, params):
+        """
+        :param path: url path e.g. /sdpapi/request/100001
+        :param params: query string parameters
+        :return: (http status, xml)
+        """
+        operation = params.get('OPERATION_NAME', '')
+        self._count(operation)
+        fields = dict(re.findall(r'<name>(.*?)</name><value>(.*?)</value>', params.get('INPUT_DATA', ''), re.S))
+        ids = re.findall(r'/request/(\d+)', path)
+        request = self._requests_by_id.get(ids[0]) if ids else None
+        needs_request = operation in ('GET_REQUEST', 'GET_ALL_CONVERSATIONS', 'GET_CONVERSATIONS')
+        if (ids or needs_request) and request is None:
+            return 200, self._operation(operation, status='Failed', message='Invalid request ID')
+        if operation == 'GET_REQUESTS':
+            frm = int(fields.get('from', 0))
+            limit = int(fields.get('limit', 100))
+            return 200, self._records(operation, self.requests[frm:frm + limit])
+        if operation == 'GET_REQUEST':
+            return 200, self._operation(operation, self._parameters(request))
+        if operation in ('GET_ALL_CONVERSATIONS', 'GET_CONVERSATIONS'):
+            return 200, self._records(operation, self._conversations(request))
+        if operation == 'GET_ALL':
+            return 200, self._records(operation, [{'technicianid': str(number), 'technicianname': name}
+                                                  for number, name in enumerate(self.technicians, 1)])
+        if operation == 'GET_REQUEST_FILTERS':
+            return 200, self._operation(operation, '<Filters>{}</Filters>'.format(self._parameters(FILTERS)))
+        if operation == 'GET_NOTES':
+            return 200, self._api(operation, '<Notes><Note>{}</Note></Notes>'.format(self._parameters(
+                {'notesid': '1', 'notestext': 'Generated note', 'ispublic': 'false'})))
+        if operation == 'ADD_REQUEST':
+            request_id = str(900000 + self.calls[operation])
+            return 200, self._operation(operation, self._parameters({'workorderid': request_id}))
+        if operation.startswith(('GET_', 'ADD_', 'EDIT_', 'DELETE_', 'CLOSE_', 'ASSIGN_', 'PICKUP_', 'REPLY_')):
+            return 200, self._operation(operation, self._parameters({'workorderid': ids[0]} if ids else {}))
+        return 200, self._operation(operation, status='Failed',
+                                    message='Operation {} is not supported.'.format(operation))
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _body(self):
+                if 'chunked' in self.headers.get('Transfer-Encoding', ''):
+                    chunks = []
+                    while True:
+                        size = int(self.rfile.readline().split(b';')[0], 16)
+                        chunks.append(self.rfile.read(size))
+                        self.rfile.readline()
+                        if not size:
+                            return b''.join(chunks)
+                return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+            def _reply(self):
+                url = urllib.parse.urlparse(self.path)
+                body = self._body()
+                if body:  # attachment upload
+                    filename = re.search(rb'filename="([^"]*)"', body)
+                    head, _, content = body.partition(b'\r\n\r\n')
+                    server.uploads.append((url.path, filename.group(1).decode() if filename else None,
+                                           len(content.rpartition(b'\r\n--')[0])))
+                if server.latency or server.jitter:
+                    time.sleep(server.latency + random.uniform(0, server.jitter))
+                status, body = server.respond(url.path, dict(urllib.parse.parse_qsl(url.query)))
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/xml;charset=UTF-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = _reply
+            do_POST = _reply
+
+        return Handler
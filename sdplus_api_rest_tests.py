@@ -1,6 +1,26 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import datetime
+import inspect
+import io
+import itertools
+import json
 import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import requests
 import unittest
-from custom_modules.sdplus_api_rest import API
+import warnings
+import xml.etree.ElementTree as ET
+import xmltodict
+from custom_modules.sdplus_api_rest import AdaptiveConcurrency, API, AsyncAPI, ConversationRecord, DiskCache, \
+    Metrics, RateLimiter, RequestExporter, RequestMirror, RequestRecord, RequestStore, RequestWatcher, RetryPolicy, \
+    TTLCache, WriteQueue, main
+from custom_modules.sdplus_api_rest_mock import MockServer
 
 sdplus_base_url = 'http://sdplus/sdpapi/'
 sdplus_api_key = os.environ['SDPLUS_ADMIN']
@@ -184,6 +204,16 @@ class RequestGeneralTest(unittest.TestCase):
         result = self.sdplus_api.request_get_requests()
         self.assertEqual(result['response_status'], 'Success')
 
+    def test_iter_requests(self):
+        expected = self.sdplus_api.request_get_requests(limit='30')
+        result = list(itertools.islice(self.sdplus_api.iter_requests(page_size=10), 30))
+        self.assertEqual([call['workorderid'] for call in result], [call['workorderid'] for call in expected])
+
+    def test_iter_requests_prefetch(self):
+        expected = self.sdplus_api.request_get_requests(limit='30')
+        result = list(itertools.islice(self.sdplus_api.iter_requests(page_size=10, prefetch=True), 30))
+        self.assertEqual([call['workorderid'] for call in result], [call['workorderid'] for call in expected])
+
     def test_request_get_request_filters(self):
         result = self.sdplus_api.request_get_request_filters()
         self.assertEqual(result['response_status'], 'Success')
@@ -255,6 +285,862 @@ class TechnicianTest(unittest.TestCase):
         self.assertEqual(result['response_status'], 'Success')
 
 
+class CreateXmlTest(unittest.TestCase):
+    @staticmethod
+    def element_tree_xml(fields, sub_elements=()):
+        operation = ET.Element('Operation')
+        parent = ET.SubElement(operation, 'Details')
+        for sub in sub_elements:
+            parent = ET.SubElement(parent, sub)
+        for key, value in fields.items():
+            param = ET.SubElement(parent, 'parameter')
+            ET.SubElement(param, 'name').text = key
+            ET.SubElement(param, 'value').text = value
+        return ET.tostring(operation)
+
+    def test_matches_element_tree(self):
+        cases = [({'subject': 'Printer & scanner <offline> "3rd" floor'}, ()),
+                 ({'isPublic': 'false', 'notesText': 'Caf\u00e9 \u20ac5 \U0001f600'}, ('Notes', 'Note')),
+                 ({'requester': '', 'group': None, 'priority': '2 High'}, ()),
+                 ({'resolutiontext': 'fixed'}, 'resolution'),
+                 ({}, ('Notes', 'Note'))]
+        for fields, sub_elements in cases:
+            for _ in range(2):  # built, then from the cached template
+                self.assertEqual(API._create_xml(fields, sub_elements), self.element_tree_xml(fields, sub_elements))
+
+    def test_non_str_values(self):
+        self.assertRaises(TypeError, API._create_xml, {'subject': 1})
+
+
+class RecordParserTest(unittest.TestCase):
+    def setUp(self):
+        record = ('<record><parameter><name>workorderid</name><value>{}</value></parameter>'
+                  '<parameter><name>subject</name><value> Printer &amp; scanner </value></parameter>'
+                  '<parameter><name>TECHNICIAN</name><value/></parameter></record>')
+        self.xml = ('<?xml version="1.0" encoding="UTF-8"?><API version="1.0"><response><operation name="GET_REQUESTS">'
+                    '<result><status>Success</status></result><Details>{}</Details></operation></response></API>')
+        self.records = [record.format(request_id) for request_id in range(3)]
+
+    def test_iter_records_matches_output_params_to_list(self):
+        for count in range(len(self.records) + 1):
+            xml = self.xml.format(''.join(self.records[:count]))
+            expected = API.output_params_to_list(xmltodict.parse(xml))
+            self.assertEqual(list(API.iter_records(xml)), expected)
+
+    def test_iter_records_chunks(self):
+        xml = self.xml.format(''.join(self.records)).encode()
+        chunks = [xml[i:i + 10] for i in range(0, len(xml), 10)]
+        self.assertEqual(list(API.iter_records(chunks)), list(API.iter_records(xml)))
+
+
+class CacheTest(unittest.TestCase):
+    def test_ttl_cache_expires(self):
+        cache = TTLCache(ttl=0.01)
+        cache.set('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('key'))
+
+    def test_ttl_cache_lru(self):
+        cache = TTLCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+
+    def test_disk_cache_shared(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'cache.db')
+            DiskCache(path).set(('key', 1), {'Simon Crouch': '1'})
+            self.assertEqual(DiskCache(path).get(('key', 1)), {'Simon Crouch': '1'})
+            DiskCache(path).invalidate()
+            self.assertIsNone(DiskCache(path).get(('key', 1)))
+
+    def test_technician_get_all_cached(self):
+        sdplus_api = API(sdplus_api_key, sdplus_base_url)
+        first = sdplus_api.technician_get_all()
+        sdplus_api.send = lambda *args, **kwargs: self.fail('technicians not cached')
+        self.assertEqual(sdplus_api.technician_get_all(), first)
+
+    def test_failure_not_cached(self):
+        with MockServer(requests=1) as server:
+            respond = server.respond
+            server.respond = lambda path, params: (200, server._operation('GET_REQUEST_FILTERS', status='Failed',
+                                                                          message='Server busy'))
+            sdplus_api = API('mock', server.url)
+            filters = sdplus_api.request_get_request_filters()
+            self.assertEqual(filters['operation']['result']['status'], 'Failed')
+            server.respond = respond  # recovered
+            self.assertEqual(sdplus_api.get_queue_ids(['All Requests']), [{'name': 'All Requests',
+                                                                           'id': 'All_Requests'}])
+            sdplus_api.close()
+
+    def test_cache_per_api_key(self):
+        cache = TTLCache()
+        with MockServer(requests=1) as server:
+            for api_key in ('first key', 'second key', 'first key'):
+                with API(api_key, server.url, cache=cache) as sdplus_api:
+                    sdplus_api.technician_get_all()
+                    sdplus_api.request_get_request_filters()
+            self.assertEqual((server.calls['GET_ALL'], server.calls['GET_REQUEST_FILTERS']), (2, 2))
+
+
+class RateLimitTest(unittest.TestCase):
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=100, burst=1)
+        started = time.monotonic()
+        for _ in range(11):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+    def test_adaptive_concurrency(self):
+        concurrency = AdaptiveConcurrency(initial=4, minimum=1, maximum=5, latency_target=1)
+        concurrency.acquire()
+        concurrency.release(latency=5)
+        self.assertEqual(concurrency.limit, 2)
+        for _ in range(2):
+            concurrency.acquire()
+            concurrency.release(latency=0.1)
+        self.assertEqual(concurrency.limit, 3)
+
+    def test_adaptive_concurrency_cut_once(self):
+        concurrency = AdaptiveConcurrency(initial=8, latency_target=1)
+        for _ in range(3):
+            concurrency.acquire()
+        for _ in range(3):  # open together, so one cut
+            concurrency.release(latency=5, failed=True)
+        self.assertEqual(concurrency.limit, 4)
+        concurrency.acquire()
+        concurrency.release(latency=0, failed=True)
+        self.assertEqual(concurrency.limit, 2)
+
+    def test_adaptive_concurrency_async(self):
+        concurrency = AdaptiveConcurrency(initial=1)
+
+        async def acquire():
+            await concurrency.acquire_async()
+            waiter = asyncio.ensure_future(concurrency.acquire_async())
+            await asyncio.sleep(0.05)
+            self.assertFalse(waiter.done())
+            threading.Timer(0.05, concurrency.release, args=(0.05,)).start()
+            started = time.monotonic()
+            await asyncio.wait_for(waiter, 1)
+            return time.monotonic() - started
+        self.assertLess(asyncio.run(acquire()), 0.5)
+        self.assertEqual(concurrency._async_waiters, [])
+
+    def test_operation_rate_limits(self):
+        sdplus_api = API(sdplus_api_key, sdplus_base_url, operation_rate_limits={'GET_REQUEST': 2})
+        started = time.monotonic()
+        for _ in range(3):
+            sdplus_api.request_view('198952')
+        self.assertGreaterEqual(time.monotonic() - started, 1)
+
+
+class RetryTest(unittest.TestCase):
+    def test_reads_retried(self):
+        retries = []
+        policy = RetryPolicy(max_attempts=3, on_retry=lambda *args: retries.append(args))
+        self.assertIsNotNone(policy.delay('GET_REQUEST', 1, requests.ConnectionError(), elapsed=0))
+        self.assertIsNotNone(policy.delay('GET_REQUEST', 2, ET.ParseError(), elapsed=0))
+        self.assertIsNone(policy.delay('GET_REQUEST', 3, requests.ConnectionError(), elapsed=0))
+        self.assertEqual([args[:2] for args in retries], [('GET_REQUEST', 1), ('GET_REQUEST', 2)])
+
+    def test_writes_opt_in(self):
+        self.assertIsNone(RetryPolicy().delay('ADD_REQUEST', 1, requests.ConnectionError(), elapsed=0))
+        policy = RetryPolicy(retry_operations=['ADD_NOTE'])
+        self.assertIsNotNone(policy.delay('ADD_NOTE', 1, requests.ConnectionError(), elapsed=0))
+
+    def test_not_transient_or_past_deadline(self):
+        policy = RetryPolicy(deadline=10)
+        self.assertIsNone(policy.delay('GET_REQUEST', 1, ValueError(), elapsed=0))
+        self.assertIsNone(policy.delay('GET_REQUEST', 1, requests.Timeout(), elapsed=10))
+
+    def test_error_page_transient(self):
+        with self.assertRaises(ET.ParseError) as raised:
+            API._parse_response('<html><body>Down for maintenance</body></html>')
+        self.assertTrue(RetryPolicy.is_transient(raised.exception))
+        self.assertFalse(RetryPolicy.is_transient(KeyError('a bug, not the server')))
+
+
+class RequestMirrorTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.mirror = RequestMirror(API(sdplus_api_key, sdplus_base_url), os.path.join(self.folder.name, 'mirror.db'))
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_sync(self):
+        result = self.mirror.sync()
+        self.assertEqual(result['failed'], 0)
+        rows = self.mirror.query('SELECT COUNT(*) AS calls FROM requests WHERE active = 1')
+        self.assertEqual(rows[0]['calls'], result['new'])
+
+    def test_sync_incremental(self):
+        self.mirror.sync()
+        result = self.mirror.sync(new_only=True)
+        self.assertEqual(result['changed'], 0)
+        self.assertEqual(result['left_queue'], 0)
+
+    def test_sync_mock(self):
+        with MockServer(requests=30, conversations=2) as server:
+            sdplus_api = API('mock', server.url)
+            mirror = RequestMirror(sdplus_api, os.path.join(self.folder.name, 'mock.db'), full_refresh_every=2)
+            self.assertEqual(mirror.sync()['new'], 30)
+            request_id = server.requests[5]['workorderid']
+            server.add_conversation(request_id)  # doesn't change the queue list
+            server.requests[3]['status'] = 'Resolved'
+            left = server.requests.pop(10)
+            server.calls.clear()
+            result = mirror.sync()
+            self.assertEqual(result, {'new': 0, 'changed': 1, 'left_queue': 1, 'refreshed': 0, 'failed': 0})
+            self.assertEqual(server.calls['GET_REQUEST'], 2)
+            sql = 'SELECT COUNT(*) AS conversations FROM conversations WHERE workorderid = ?'
+            self.assertEqual(mirror.query(sql, (request_id,))[0]['conversations'], 2)
+            self.assertEqual(mirror.query('SELECT active FROM requests WHERE workorderid = ?',
+                                          (left['workorderid'],)), [{'active': 0}])
+            result = mirror.sync()  # full refresh
+            self.assertEqual(result['refreshed'], 29)
+            self.assertEqual(mirror.query(sql, (request_id,))[0]['conversations'], 3)
+            self.assertEqual(mirror.sync(new_only=True)['refreshed'], 0)
+            self.assertEqual(mirror.sync()['refreshed'], 0)
+            sdplus_api.close()
+
+
+class RequestStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.requests = [
+            {'workorderid': '1', 'status': 'Open', 'TECHNICIAN': 'Simon Crouch', 'requester': 'Harriet Barnard',
+             'isoverdue': 'false', 'createdtime': datetime.datetime(2016, 6, 13, 9)},
+            {'workorderid': '2', 'status': 'Open', 'TECHNICIAN': None, 'requester': 'Yasmin Daniels',
+             'isoverdue': 'true', 'createdtime': datetime.datetime(2016, 6, 14, 9)},
+            {'workorderid': '3', 'status': 'Hold', 'TECHNICIAN': 'Simon Crouch', 'requester': 'Yasmin Daniels',
+             'isoverdue': 'true', 'createdtime': datetime.datetime(2016, 6, 15, 9)},
+        ]
+        self.store = RequestStore(self.requests)
+
+    def test_query_fields(self):
+        result = self.store.query(status='Open', technician='Simon Crouch')
+        self.assertEqual([request['workorderid'] for request in result], ['1'])
+        result = self.store.query(overdue=True)
+        self.assertEqual([request['workorderid'] for request in result], ['3', '2'])
+
+    def test_query_created(self):
+        result = self.store.query(created_after=datetime.datetime(2016, 6, 14), requester='Yasmin Daniels')
+        self.assertEqual([request['workorderid'] for request in result], ['3', '2'])
+        result = self.store.query(created_before=datetime.datetime(2016, 6, 14))
+        self.assertEqual([request['workorderid'] for request in result], ['1'])
+
+    def test_add_replaces(self):
+        self.store.add([dict(self.requests[0], status='Closed')])
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(self.store.query(status='Open')[0]['workorderid'], '2')
+        self.assertEqual(self.store.query(status='Closed')[0]['workorderid'], '1')
+
+
+class RecordTest(unittest.TestCase):
+    def test_dict_like(self):
+        record = RequestRecord(['workorderid', 'status'], ['184699', 'Open'])
+        record['status'] = 'Closed'
+        record['TECHNICIAN'] = 'Simon Crouch'
+        self.assertEqual(record, {'workorderid': '184699', 'status': 'Closed', 'TECHNICIAN': 'Simon Crouch'})
+        del record['TECHNICIAN']
+        self.assertEqual(list(record), ['workorderid', 'status'])
+
+    def test_lazy_datetime(self):
+        record = RequestRecord(['workorderid', 'createdtime'], ['184699', '1465832199994'])
+        self.assertEqual(record['createdtime'], API.epoch_to_datetime('1465832199994'))
+        conversation = ConversationRecord(['createddate'], ['1465832199994'])
+        self.assertIsInstance(conversation['createddate'], datetime.datetime)
+
+    def test_shared_index(self):
+        first = RequestRecord(['workorderid', 'status'], ['1', 'Open'])
+        second = RequestRecord(['workorderid', 'status'], ['2', 'Open'])
+        self.assertIs(first._index, second._index)
+
+    def test_indexes_bounded(self):
+        record = RequestRecord(['workorderid'], ['1'])
+        indexes = len(RequestRecord._indexes)
+        for number in range(100):
+            record['field {}'.format(number)] = number
+            del record['field {}'.format(number)]
+        self.assertEqual(record, {'workorderid': '1'})
+        self.assertEqual(len(RequestRecord._indexes), indexes)  # changed records don't add shared indexes
+        for number in range(RequestRecord._max_indexes * 2):
+            RequestRecord(['field {}'.format(number)], [number])
+        self.assertLessEqual(len(RequestRecord._indexes), RequestRecord._max_indexes)
+
+    def test_copy(self):
+        record = RequestRecord(['workorderid', 'createdtime'], ['184699', '1465832199994'])
+        copied = record.copy()
+        copied['status'] = 'Open'
+        self.assertIsInstance(copied, RequestRecord)
+        self.assertEqual(list(record), ['workorderid', 'createdtime'])
+        self.assertEqual(copied['createdtime'], record['createdtime'])
+        self.assertEqual(copied['status'], 'Open')
+
+
+class MockServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer(requests=25, conversations=3)
+        self.server.start()
+        self.sdplus_api = API('mock', self.server.url)
+
+    def tearDown(self):
+        self.sdplus_api.close()
+        self.server.stop()
+
+    def test_request_get_requests(self):
+        result = self.sdplus_api.request_get_requests(limit='10', frm='20')
+        self.assertEqual([call['workorderid'] for call in result],
+                         [request['workorderid'] for request in self.server.requests[20:]])
+
+    def test_request_view(self):
+        result = self.sdplus_api.request_view(self.server.requests[0]['workorderid'])
+        self.assertEqual(result['response_status'], 'Success')
+        self.assertEqual(result['subject'], self.server.requests[0]['subject'])
+
+    def test_request_get_all_conversations(self):
+        result = self.sdplus_api.request_get_all_conversations(self.server.requests[0]['workorderid'])
+        self.assertEqual(len(result), 3)
+
+    def test_technician_get_all(self):
+        self.assertEqual(self.sdplus_api.technician_get_all()['Technician 1'], '1')
+
+    def test_request_filters_copied(self):
+        filters = self.sdplus_api.request_get_request_filters()
+        filters.clear()
+        self.assertTrue(self.sdplus_api.request_get_request_filters())
+        self.assertEqual(self.server.calls['GET_REQUEST_FILTERS'], 1)
+
+        async def request_filters():
+            async with AsyncAPI('mock', self.server.url, cache=self.sdplus_api.cache) as sdplus_api:
+                (await sdplus_api.request_get_request_filters()).clear()
+                return await sdplus_api.request_get_request_filters()
+        self.assertTrue(asyncio.run(request_filters()))
+
+    def test_iter_requests_stopped(self):
+        self.server.latency = 0.5
+        calls = self.sdplus_api.iter_requests(page_size=10, prefetch=True)
+        first = [call['workorderid'] for call in itertools.islice(calls, 3)]
+        started = time.monotonic()
+        calls.close()
+        self.assertLess(time.monotonic() - started, 0.25)  # didn't wait for the prefetched page
+        self.assertEqual(first, [request['workorderid'] for request in self.server.requests[:3]])
+
+    def test_async_with_only(self):
+        sdplus_api = AsyncAPI('mock', self.server.url)
+        with self.assertRaisesRegex(TypeError, 'async with'):
+            with sdplus_api:
+                pass
+
+    def test_async_bulk_stopped(self):
+        async def first_result():
+            async with AsyncAPI('mock', self.server.url) as sdplus_api:
+                ids = [request['workorderid'] for request in self.server.requests[:8]]
+                results = sdplus_api.bulk('request_view', ids, max_workers=4)
+                first = await results.__anext__()
+                await results.aclose()
+                return first, asyncio.all_tasks() - {asyncio.current_task()}
+        self.server.jitter = 0.2
+        first, pending = asyncio.run(first_result())
+        self.assertIsNone(first.error)
+        self.assertEqual(pending, set())
+
+    def test_async_iter_requests_stopped(self):
+        async def first_calls(prefetch):
+            async with AsyncAPI('mock', self.server.url) as sdplus_api:
+                calls = sdplus_api.iter_requests(page_size=10, prefetch=prefetch)
+                first = [(await calls.__anext__())['workorderid'] for _ in range(12)]
+                await calls.aclose()
+                pending = asyncio.all_tasks() - {asyncio.current_task()}
+                await asyncio.gather(*pending, return_exceptions=True)
+                return first, [task.cancelled() for task in pending]
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            for prefetch, cancelled in ((False, []), (True, [True])):
+                first, tasks = asyncio.run(first_calls(prefetch))
+                self.assertEqual(first, [request['workorderid'] for request in self.server.requests[:12]])
+                self.assertEqual(tasks, cancelled)
+        self.assertEqual([str(warning.message) for warning in caught if warning.category is RuntimeWarning], [])
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer(requests=10)
+        self.server.start()
+        self.calls = []
+        self.metrics = Metrics(callback=self.calls.append)
+        self.sdplus_api = API('mock', self.server.url, metrics=self.metrics)
+
+    def tearDown(self):
+        self.sdplus_api.close()
+        self.server.stop()
+
+    def test_phases(self):
+        self.sdplus_api.request_view(self.server.requests[0]['workorderid'])
+        call = self.calls[0]
+        self.assertEqual((call['operation'], call['status'], call['attempts']), ('GET_REQUEST', 'Success', 1))
+        self.assertEqual(set(call['phases']), {'build', 'http', 'parse'})
+        self.assertGreater(call['response_bytes'], 0)
+
+    def test_prometheus(self):
+        self.sdplus_api.request_get_requests(limit='5')
+        self.sdplus_api.technician_get_all()
+        text = self.metrics.prometheus()
+        self.assertIn('sdplus_calls_total{operation="GET_REQUESTS",status="ok"} 1', text)
+        self.assertIn('sdplus_phase_seconds_count{operation="GET_ALL",phase="xmltodict"} 1', text)
+        self.assertIn('sdplus_phase_seconds_count{operation="GET_ALL",phase="postprocess"} 1', text)
+
+
+class RequestWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer(requests=250)
+        self.server.start()
+        self.sdplus_api = API('mock', self.server.url)
+        self.watcher = RequestWatcher(self.sdplus_api, page_size=100, full_scan_every=3)
+        self.events = []
+        self.watcher.subscribe(self.events.append)
+
+    def tearDown(self):
+        self.sdplus_api.close()
+        self.server.stop()
+
+    def test_events(self):
+        self.assertEqual(self.watcher.poll(), [])  # first poll only records the queue
+        self.server.calls.clear()
+        new = self.server.add_request(subject='Printer offline')
+        self.server.requests[10]['status'] = 'Resolved'
+        self.server.add_conversation(self.server.requests[20]['workorderid'])
+        events = self.watcher.poll()
+        self.assertEqual(self.server.calls['GET_REQUESTS'], 1)  # stopped at requests already seen
+        self.assertEqual([(event.type, event.request_id) for event in events if event.type != 'conversation'],
+                         [('created', new['workorderid']), ('updated', self.server.requests[10]['workorderid'])])
+        self.assertEqual({event.request_id for event in events if event.type == 'conversation'}, {new['workorderid']})
+        self.assertEqual(self.watcher.poll(), [])
+        events = self.watcher.poll()  # full scan
+        self.assertEqual([(event.type, event.request_id) for event in events],
+                         [('conversation', self.server.requests[20]['workorderid'])])
+        self.assertEqual(len(self.events), 8)
+
+    def test_subscribe_types(self):
+        self.assertRaises(ValueError, self.watcher.subscribe, print, ['deleted'])
+        created = []
+        self.watcher.subscribe(created.append, types=['created'])
+        self.watcher.poll()
+        self.server.add_request()
+        self.server.requests[5]['status'] = 'Resolved'
+        self.watcher.poll()
+        self.assertEqual([event.type for event in created], ['created'])
+
+    def test_failing_subscriber(self):
+        def fail(event):
+            raise RuntimeError('subscriber failed')
+        watcher = RequestWatcher(self.sdplus_api, page_size=100)
+        received = []
+        watcher.subscribe(fail)
+        watcher.subscribe(received.append)
+        watcher.poll()
+        new = self.server.add_request()
+        events = watcher.poll()
+        self.assertEqual(received, events)
+        self.assertIn(new['workorderid'], [event.request_id for event in received])
+        event, error = watcher.last_callback_error
+        self.assertIsInstance(error, RuntimeError)
+
+
+class RequestExporterTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer(requests=120, conversations=2)
+        self.server.start()
+        self.sdplus_api = API('mock', self.server.url)
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.sdplus_api.close()
+        self.server.stop()
+        self.folder.cleanup()
+
+    def exported(self, table):
+        rows = []
+        for name in sorted(os.listdir(self.folder.name)):
+            if name.startswith(table + '-'):
+                with open(os.path.join(self.folder.name, name)) as file:
+                    rows.extend(json.loads(line) for line in file)
+        return rows
+
+    def test_export_and_resume(self):
+        exporter = RequestExporter(self.sdplus_api, self.folder.name, range_size=50, processes=2)
+        counts = exporter.run()
+        self.assertEqual((counts['requests'], counts['conversations']), (120, 240))
+        self.assertEqual(list(dict.fromkeys(row['workorderid'] for row in self.exported('requests'))),
+                         [request['workorderid'] for request in self.server.requests])  # shards overlap
+        with open(exporter.checkpoint_path) as file:
+            checkpoint = json.load(file)
+        checkpoint['done'].remove(50)  # as if that range had failed
+        with open(exporter.checkpoint_path, 'w') as file:
+            json.dump(checkpoint, file)
+        self.server.add_request()  # logged since the export started
+        counts = exporter.run()
+        # done can include an empty range past the end, depending on which range finished first
+        self.assertEqual((counts['ranges'], counts['skipped'], counts['requests']), (1, len(checkpoint['done']), 50))
+        self.assertEqual({row['workorderid'] for row in self.exported('requests')},
+                         {request['workorderid'] for request in self.server.requests})  # new one too, via the overlap
+
+    def test_closed_before_resume(self):
+        exporter = RequestExporter(self.sdplus_api, self.folder.name, range_size=50, processes=1, overlap=5,
+                                   conversations=False)
+        exporter.run()
+        with open(exporter.checkpoint_path) as file:
+            checkpoint = json.load(file)
+        checkpoint['done'].remove(100)  # as if that range had failed
+        with open(exporter.checkpoint_path, 'w') as file:
+            json.dump(checkpoint, file)
+        moved = self.server.requests[100]['workorderid']
+        self.server.requests.pop(10)  # closed, so the first request of range 100 is now in range 50
+        self.assertEqual(exporter.run()['requests'], 19)
+        self.assertIn(moved, {row['workorderid'] for row in self.exported('requests')})
+
+    def test_limits_shared(self):
+        sdplus_api = API('mock', self.server.url, rate_limit=100, operation_rate_limits={'GET_REQUESTS': 10},
+                         concurrency=AdaptiveConcurrency(initial=8, maximum=16),
+                         retry=RetryPolicy(max_attempts=5, retry_operations=['EDIT_REQUEST']))
+        exporter = RequestExporter(sdplus_api, self.folder.name, range_size=50, processes=2, conversations=False)
+        rate_limit, operation_rate_limits, concurrency, retry = exporter._settings()['limits']
+        self.assertEqual(rate_limit, (50, 1))
+        self.assertEqual(operation_rate_limits, (('GET_REQUESTS', (5, 1)),))
+        self.assertEqual(concurrency, (4, 1, 8, 2.0))
+        self.assertEqual((retry[0], retry[-1]), (5, ('EDIT_REQUEST',)))
+        self.assertEqual(exporter.run()['requests'], 120)
+        sdplus_api.close()
+
+    def test_checkpoint_settings(self):
+        RequestExporter(self.sdplus_api, self.folder.name, range_size=100, conversations=False).run()
+        self.assertRaises(ValueError, RequestExporter(self.sdplus_api, self.folder.name, range_size=50).run)
+
+
+class WriteQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer(requests=10, latency=0.05)
+        self.server.start()
+        self.sdplus_api = API('mock', self.server.url)
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'writes.db')
+
+    def tearDown(self):
+        self.sdplus_api.close()
+        self.server.stop()
+        self.folder.cleanup()
+
+    def test_merged_in_order(self):
+        results = []
+        writes = WriteQueue(self.sdplus_api, self.path, max_workers=2,
+                            on_result=lambda write, result, error: results.append((write.operation, write.args)))
+        writes.note_add('100001', 'False', 'first')  # sent straight away, so the edits after it queue up
+        for number in range(5):
+            writes.request_edit('100001', {'subject': 'Edit {}'.format(number), 'field{}'.format(number): 'x'})
+        writes.request_assign('100001', '1')
+        writes.request_assign('100001', '2')
+        self.assertTrue(writes.close(timeout=10))
+        self.assertEqual(results, [
+            ('note_add', ['False', 'first']),
+            ('request_edit', [{'subject': 'Edit 4', 'field0': 'x', 'field1': 'x', 'field2': 'x', 'field3': 'x',
+                               'field4': 'x'}]),
+            ('request_assign', ['2'])])
+        self.assertRaises(RuntimeError, writes.note_add, '100001')
+
+    def test_kept_until_sent(self):
+        down = API('mock', 'http://127.0.0.1:1/sdpapi/')  # connection refused - retried
+        writes = WriteQueue(down, self.path, retry_delay=0.05)
+        writes.note_add('100002', 'False', 'kept')
+        writes.request_edit('100002', {'subject': 'kept'})
+        self.assertFalse(writes.close(timeout=0.3))
+        writes = WriteQueue(self.sdplus_api, self.path)
+        self.assertEqual(len(writes), 2)
+        self.assertTrue(writes.close(timeout=10))
+        self.assertEqual((self.server.calls['ADD_NOTE'], self.server.calls['EDIT_REQUEST']), (1, 1))
+
+    def test_error_page(self):
+        operations = []
+        self.server.respond = lambda path, params: (operations.append(params['OPERATION_NAME']) or
+                                                    (200, '<html><body>Down for maintenance<br></body></html>'))
+        sdplus_api = API('mock', self.server.url,
+                         retry=RetryPolicy(max_attempts=2, backoff=0.01, retry_operations=['EDIT_REQUEST']))
+        results = []
+
+        def on_result(write, result, error):
+            results.append((write.operation, type(error)))
+            raise RuntimeError('callback failed')
+        writes = WriteQueue(sdplus_api, retry_delay=0.01, max_attempts=3, on_result=on_result)
+        writes.note_add('100001', 'False', 'not retried - it may have been added')
+        writes.request_edit('100002', {'subject': 'retried'})
+        self.assertTrue(writes.close(timeout=10))
+        sdplus_api.close()
+        self.assertEqual(operations.count('ADD_NOTE'), 1)
+        self.assertEqual(operations.count('EDIT_REQUEST'), 2)  # retried by send(), not again by the queue
+        self.assertEqual(sorted(results), [('note_add', ET.ParseError), ('request_edit', ET.ParseError)])
+        self.assertIsInstance(writes.last_callback_error[1], RuntimeError)
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer(requests=10, latency=0.1)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_threads(self):
+        sdplus_api = API('mock', self.server.url)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+            views = list(executor.map(lambda _: sdplus_api.request_view('100001'), range(10)))
+            list(executor.map(lambda _: sdplus_api.request_edit('100001', {'subject': 'Edited'}), range(3)))
+        sdplus_api.close()
+        self.assertEqual(self.server.calls, {'GET_REQUEST': 1, 'EDIT_REQUEST': 3})  # writes aren't shared
+        self.assertTrue(all(view == views[0] for view in views))
+        self.assertEqual(len({id(view) for view in views}), 10)  # each caller has its own copy
+        self.assertEqual(sdplus_api.single_flight.shared, 9)
+
+    def test_results_not_shared(self):
+        metrics = Metrics()
+        sdplus_api = API('mock', self.server.url, metrics=metrics)
+
+        def view(number):
+            result = sdplus_api.request_view('100001')
+            for key in range(200):  # changed while other callers may still be copying
+                result['added {} {}'.format(number, key)] = key
+            return result
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            views = list(executor.map(view, range(16)))
+        sdplus_api.close()
+        self.assertEqual(self.server.calls, {'GET_REQUEST': 1})
+        for number, result in enumerate(views):
+            self.assertEqual({key.split()[1] for key in result if key.startswith('added')}, {str(number)})
+        self.assertEqual(metrics.calls['GET_REQUEST', 'Success'], 1)
+        self.assertEqual(metrics.calls['GET_REQUEST', 'shared'], 15)
+
+    def test_async(self):
+        async def views():
+            async with AsyncAPI('mock', self.server.url) as sdplus_api:
+                return await asyncio.gather(*[sdplus_api.request_get_all_conversations('100001') for _ in range(10)])
+        results = asyncio.run(views())
+        self.assertEqual(self.server.calls, {'GET_ALL_CONVERSATIONS': 1})
+        self.assertTrue(all(result == results[0] for result in results))
+
+    def test_async_cancelled(self):
+        async def view(cancel):
+            async with AsyncAPI('mock', self.server.url) as sdplus_api:
+                views = [asyncio.ensure_future(sdplus_api.request_view('100001')) for _ in range(2)]
+                await asyncio.sleep(0.02)
+                for task in views[:cancel]:
+                    task.cancel()
+                results = await asyncio.gather(*views, return_exceptions=True)
+                return results, asyncio.all_tasks() - {asyncio.current_task()}
+        (cancelled, result), pending = asyncio.run(view(cancel=1))
+        self.assertIsInstance(cancelled, asyncio.CancelledError)
+        self.assertEqual(result['workorderid'], '100001')  # one caller cancelled doesn't cancel the call
+        results, pending = asyncio.run(view(cancel=2))
+        self.assertTrue(all(isinstance(result, asyncio.CancelledError) for result in results))
+        self.assertEqual(pending, set())  # every caller cancelled does
+
+    def test_off(self):
+        sdplus_api = API('mock', self.server.url, single_flight=False)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+            list(executor.map(lambda _: sdplus_api.request_view('100001'), range(5)))
+        sdplus_api.close()
+        self.assertEqual(self.server.calls, {'GET_REQUEST': 5})
+
+
+class CommandLineTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer(requests=10)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def run_main(self, *args):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            code = main(['--key', 'mock', '--url', self.server.url] + list(args))
+        return code, json.loads(output.getvalue())
+
+    def test_commands(self):
+        code, result = self.run_main('view', '100001')
+        self.assertEqual((code, result['workorderid']), (0, '100001'))
+        code, result = self.run_main('note', '100001', 'Chased supplier')
+        self.assertEqual((code, self.server.calls['ADD_NOTE']), (0, 1))
+        code, result = self.run_main('close', '100001', '--comment', 'Fixed')
+        self.assertEqual(self.server.calls['CLOSE_REQUEST'], 1)
+        code, result = self.run_main('list', '--limit', '3')
+        self.assertEqual([call['workorderid'] for call in result], ['100009', '100008', '100007'])
+        code, result = self.run_main('view', '1')
+        self.assertEqual((code, result['response_status']), (1, 'Failed'))
+
+    def test_import_is_lazy(self):
+        folder = os.path.dirname(inspect.getfile(API))
+        loaded = subprocess.run([sys.executable, '-c', 'import sys, sdplus_api_rest; print(sorted(name for name in '
+                                 '("requests", "xmltodict", "aiohttp", "asyncio") if name in sys.modules))'],
+                                cwd=folder, capture_output=True, text=True, check=True).stdout
+        self.assertEqual(loaded.strip(), '[]')
+
+
+class VersionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer(requests=10, conversations=3)
+        self.server.start()
+        self.sdplus_api = API('mock', self.server.url)
+
+    def tearDown(self):
+        self.sdplus_api.close()
+        self.server.stop()
+
+    def test_request_view_changed(self):
+        self.assertEqual(self.sdplus_api.request_view_changed('100001')['workorderid'], '100001')
+        self.assertIsNone(self.sdplus_api.request_view_changed('100001'))
+        self.server.requests[-2]['status'] = 'Resolved'  # 100001
+        self.assertEqual(self.sdplus_api.request_view_changed('100001')['status'], 'Resolved')
+        self.assertIsNone(self.sdplus_api.request_view_changed('100001'))
+        self.sdplus_api.versions.forget('100001')
+        self.assertIsNotNone(self.sdplus_api.request_view_changed('100001'))
+        for _ in range(2):  # failures aren't remembered
+            self.assertEqual(self.sdplus_api.request_view_changed('1')['response_status'], 'Failed')
+
+    def test_request_get_new_conversations(self):
+        self.assertEqual(len(self.sdplus_api.request_get_new_conversations('100001')), 3)
+        self.assertEqual(self.sdplus_api.request_get_new_conversations('100001'), [])
+        self.server.add_conversation('100001', 'New reply')
+        new = self.sdplus_api.request_get_new_conversations('100001')
+        self.assertEqual([conversation['subject'] for conversation in new], ['New reply'])
+        self.assertIsInstance(new[0], ConversationRecord)
+        self.assertEqual(self.sdplus_api.request_get_new_conversations('100001'), [])
+
+    def test_concurrent_new_conversations(self):
+        self.sdplus_api.versions.compare_and_set(('GET_REQUEST', '1'), None, 'first')
+        self.assertFalse(self.sdplus_api.versions.compare_and_set(('GET_REQUEST', '1'), None, 'second'))
+        versions = self.sdplus_api.versions
+        get = versions.get
+        versions.get = lambda *args: (get(*args), time.sleep(0.05))[0]  # all calls read before any updates
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda _: self.sdplus_api.request_get_new_conversations('100001'), range(8)))
+        self.assertEqual(sum(len(result) for result in results), 3)  # each conversation returned once
+
+    def test_async(self):
+        async def fetch():
+            async with AsyncAPI('mock', self.server.url) as sdplus_api:
+                return [await sdplus_api.request_view_changed('100002'), await sdplus_api.request_view_changed('100002'),
+                        await sdplus_api.request_get_new_conversations('100002'),
+                        await sdplus_api.request_get_new_conversations('100002')]
+        view, unchanged, conversations, no_conversations = asyncio.run(fetch())
+        self.assertEqual((view['workorderid'], unchanged), ('100002', None))
+        self.assertEqual((len(conversations), no_conversations), (3, []))
+
+
+class AttachmentTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer(requests=3)
+        self.server.start()
+        self.sdplus_api = API('mock', self.server.url)
+        self.request_id = self.server.requests[0]['workorderid']
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'log.txt')
+        with open(self.path, 'wb') as file:
+            file.write(b'x' * 200000)
+
+    def tearDown(self):
+        self.sdplus_api.close()
+        self.server.stop()
+        self.folder.cleanup()
+
+    def test_path(self):
+        result = self.sdplus_api.request_add_attachment(self.request_id, self.path)
+        self.assertEqual(result['response_status'], 'Success')
+        self.assertEqual(self.server.uploads[0][1:], ('log.txt', 200000))
+
+    def test_file_object_and_iterator(self):
+        with open(self.path, 'rb') as file:
+            self.sdplus_api.request_add_attachment(self.request_id, ('renamed.txt', file))
+            self.assertFalse(file.closed)
+        self.sdplus_api.request_add_attachment(self.request_id, ('chunks.txt', (b'abc' for _ in range(10))))
+        self.assertEqual([upload[1:] for upload in self.server.uploads], [('renamed.txt', 200000), ('chunks.txt', 30)])
+
+    def test_retry(self):
+        respond = self.server.respond
+        statuses = []
+
+        def busy_once(path, params):
+            statuses.append(503 if not statuses else 200)
+            return (503, '') if statuses[-1] == 503 else respond(path, params)
+        self.server.respond = busy_once
+        sdplus_api = API('mock', self.server.url, retry=RetryPolicy(backoff=0.01, retry_operations=['ADD_ATTACHMENT']))
+        with open(self.path, 'rb') as file:
+            result = sdplus_api.request_add_attachment(self.request_id, ('seekable.txt', file))
+        self.assertEqual(result['response_status'], 'Success')
+        statuses.clear()
+        self.assertRaises(requests.HTTPError, sdplus_api.request_add_attachment, self.request_id,
+                          ('chunks.txt', (b'abc' for _ in range(10))))  # can't be read again, so not retried
+        sdplus_api.close()
+        self.assertEqual([upload[1:] for upload in self.server.uploads],
+                         [('seekable.txt', 200000), ('seekable.txt', 200000), ('chunks.txt', 30)])
+
+    def test_request_add_attachments(self):
+        request_ids = [request['workorderid'] for request in self.server.requests]
+        results = list(self.sdplus_api.request_add_attachments(itertools.product(request_ids, [self.path])))
+        self.assertEqual(len(results), 3)
+        self.assertFalse([result.error for result in results if result.error])
+        self.assertEqual(len(self.server.uploads), 3)
+
+
+class SessionTest(unittest.TestCase):
+    def test_session_reused(self):
+        sdplus_api = API(sdplus_api_key, sdplus_base_url)
+        self.assertIs(sdplus_api.session, sdplus_api.session)
+
+    def test_context_manager_closes_session(self):
+        with API(sdplus_api_key, sdplus_base_url) as sdplus_api:
+            sdplus_api.request_get_requests(limit='1')
+            self.assertIsNotNone(sdplus_api._session)
+        self.assertIsNone(sdplus_api._session)
+
+
+class BulkTest(unittest.TestCase):
+    def setUp(self):
+        self.sdplus_api = API(sdplus_api_key, sdplus_base_url)
+        self.request_id = '198952'
+
+    def test_bulk_note_view_all(self):
+        results = list(self.sdplus_api.bulk('note_view_all', [self.request_id] * 3, max_workers=3))
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertIsNone(result.error)
+            self.assertEqual(result.result['response_status'], 'Success')
+
+    def test_bulk_reports_errors(self):
+        results = list(self.sdplus_api.bulk(self.sdplus_api.request_view, [(None,)]))
+        self.assertIsInstance(results[0].error, TypeError)
+
+
+class AsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.request_id = '198952'
+
+    def test_request_view(self):
+        async def request_view():
+            async with AsyncAPI(sdplus_api_key, sdplus_base_url) as sdplus_api:
+                return await sdplus_api.request_view(self.request_id)
+        result = asyncio.run(request_view())
+        self.assertEqual(result['response_status'], 'Success')
+
+    def test_technician_get_all(self):
+        async def technician_get_all():
+            async with AsyncAPI(sdplus_api_key, sdplus_base_url) as sdplus_api:
+                return await sdplus_api.technician_get_all()
+        result = asyncio.run(technician_get_all())
+        self.assertTrue(result)
+
+
 class CustomTest(unittest.TestCase):
     def setUp(self):
         self.sdplus_api = API(sdplus_api_key, sdplus_base_url)